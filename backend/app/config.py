@@ -9,6 +9,20 @@ BASE_DIR = Path(__file__).parent.parent
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{BASE_DIR}/attendance.db")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")  # Default: DATABASE_URL with its async driver (aiosqlite, asyncpg)
+# SQLite connection pragmas (WAL lets readers run alongside the writer)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is safe with WAL, FULL syncs every commit
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))  # Wait for locks instead of "database is locked"
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))  # Page cache per connection
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # Bytes of the file memory-mapped (0 = off)
+# Connection pool for server databases (PostgreSQL, MySQL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds before a connection is replaced
+# Held while creating tables and migrating, so server workers starting together run it one at a time
+DB_INIT_LOCK_PATH = Path(os.getenv("DB_INIT_LOCK_PATH", str(BASE_DIR / "data" / "init_db.lock")))
 
 # User images directory
 USER_IMAGES_DIR = BASE_DIR / "data" / "user_images"
@@ -21,6 +35,58 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Face Recognition Settings
 FACE_RECOGNITION_THRESHOLD = 0.4  # Default threshold for face matching (lower = more strict/accurate)
+FACE_DETECTION_PROFILE = os.getenv("FACE_DETECTION_PROFILE", "balanced")  # fast | balanced | accurate
+FACE_DETECTION_MAX_SIDE = int(os.getenv("FACE_DETECTION_MAX_SIDE", "640"))  # Longest side of the image copy used for detection
+FACE_ENCODING_MAX_SIDE = int(os.getenv("FACE_ENCODING_MAX_SIDE", "1600"))  # Longest side of decoded enrollment photos
+# Gallery search index: "exact" brute-force scan or "ivf" approximate index for very large galleries
+FACE_INDEX_TYPE = os.getenv("FACE_INDEX_TYPE", "exact")
+FACE_IVF_NLIST = int(os.getenv("FACE_IVF_NLIST", "0"))  # IVF lists (0 = about 4 * sqrt(gallery size))
+FACE_IVF_NPROBE = int(os.getenv("FACE_IVF_NPROBE", "8"))  # Lists scanned per query (higher = better recall, slower)
+FACE_IVF_MIN_SIZE = int(os.getenv("FACE_IVF_MIN_SIZE", "50000"))  # Smaller galleries always use the exact scan
+FACE_IVF_REBUILD_DELAY = float(os.getenv("FACE_IVF_REBUILD_DELAY", "30"))  # Min seconds between background re-clusterings
+# Gallery snapshot file memory-mapped by every server process ("" disables it)
+GALLERY_SNAPSHOT_PATH = os.getenv("GALLERY_SNAPSHOT_PATH", str(BASE_DIR / "data" / "gallery.snapshot"))
+GALLERY_SNAPSHOT_DELAY = float(os.getenv("GALLERY_SNAPSHOT_DELAY", "2"))  # Seconds changes are batched before rewriting it
+GALLERY_SNAPSHOT_MIN_INTERVAL = float(os.getenv("GALLERY_SNAPSHOT_MIN_INTERVAL", "60"))  # Min seconds between full rewrites
+MAX_FACE_TEMPLATES = int(os.getenv("MAX_FACE_TEMPLATES", "5"))  # Encodings kept per user, oldest dropped first
+MAX_IDENTIFY_FRAMES = int(os.getenv("MAX_IDENTIFY_FRAMES", "16"))  # Max frames per /api/attendance/identify call
+
+# Face processing pool (detection/encoding runs in separate processes)
+FACE_WORKERS = int(os.getenv("FACE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+FACE_QUEUE_LIMIT = int(os.getenv("FACE_QUEUE_LIMIT", str(FACE_WORKERS * 4)))  # Jobs in flight before returning 503
+BULK_ENROLL_BATCH_SIZE = int(os.getenv("BULK_ENROLL_BATCH_SIZE", "50"))  # Images committed per transaction
+BULK_ENROLL_MAX_FILES = int(os.getenv("BULK_ENROLL_MAX_FILES", "10000"))  # Images per uploaded ZIP
+BULK_ENROLL_MAX_BYTES = int(os.getenv("BULK_ENROLL_MAX_BYTES", str(2 * 1024 ** 3)))  # Uncompressed size of the images of a ZIP
+BULK_ENROLL_WAIT_TIMEOUT = float(os.getenv("BULK_ENROLL_WAIT_TIMEOUT", "60"))  # Seconds an upload waits for busy face workers
+
+# Attendance ingestion
+MAX_SCAN_BATCH = int(os.getenv("MAX_SCAN_BATCH", "1000"))  # Max scans per /api/attendance/scan/batch call
+# Write-behind: acknowledge scans once journaled, commit them in groups (single server process only)
+SCAN_WRITE_BEHIND = os.getenv("SCAN_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+SCAN_FLUSH_INTERVAL_MS = int(os.getenv("SCAN_FLUSH_INTERVAL_MS", "50"))  # Max delay before a group commit
+SCAN_FLUSH_MAX_BATCH = int(os.getenv("SCAN_FLUSH_MAX_BATCH", "500"))  # Queued scans that trigger a group commit early
+SCAN_JOURNAL_PATH = Path(os.getenv("SCAN_JOURNAL_PATH", str(BASE_DIR / "data" / "scan_journal.jsonl")))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))  # Server processes (uvicorn's default for --workers)
+SETTINGS_REVALIDATE_INTERVAL = float(os.getenv("SETTINGS_REVALIDATE_INTERVAL", "5"))  # Seconds between settings revision checks
+
+# WebSocket fan-out
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))  # Messages queued per client
+WS_SLOW_CLIENT_POLICY = os.getenv("WS_SLOW_CLIENT_POLICY", "drop_oldest")  # Full queue: "drop_oldest" or "disconnect"
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))  # Seconds before a stuck client is disconnected
+# Relay of broadcasts between server processes: "memory" (single process) or "sqlite" (shared event log, one host)
+WS_BACKPLANE = os.getenv("WS_BACKPLANE", "memory")
+WS_BACKPLANE_PATH = Path(os.getenv("WS_BACKPLANE_PATH", str(BASE_DIR / "data" / "ws_events.db")))
+WS_BACKPLANE_POLL_MS = int(os.getenv("WS_BACKPLANE_POLL_MS", "50"))  # Event log tailing interval
+WS_BACKPLANE_RETENTION = float(os.getenv("WS_BACKPLANE_RETENTION", "300"))  # Seconds events are kept
+
+# Camera streaming (kiosk -> dashboards)
+CAMERA_MAX_FPS = float(os.getenv("CAMERA_MAX_FPS", "10"))  # Frames per second relayed per device (0 = unlimited)
+CAMERA_PREVIEW_MAX_SIDE = int(os.getenv("CAMERA_PREVIEW_MAX_SIDE", "640"))  # Longest side of relayed frames (0 = as sent)
+CAMERA_PREVIEW_QUALITY = int(os.getenv("CAMERA_PREVIEW_QUALITY", "70"))  # JPEG quality of downscaled frames
+CAMERA_DEVICE_TOKEN = os.getenv("CAMERA_DEVICE_TOKEN", "")  # Shared kiosk token for publishing cameras ("" = JWT only)
+
+# Reports
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))  # Rows fetched and streamed per chunk by /api/attendance/export
 
 # CORS Settings
 CORS_ORIGINS = [
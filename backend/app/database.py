@@ -1,25 +1,104 @@
 """
 Database setup and session management
 """
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, event, Boolean, Column, Integer, String, Float, Date, DateTime, ForeignKey, Text, LargeBinary, Index
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred, validates
+from contextlib import contextmanager
 from datetime import datetime
 import json
 import numpy as np
 
-from app.config import DATABASE_URL
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks
+    fcntl = None
+
+from app.config import (
+    DATABASE_URL, ASYNC_DATABASE_URL, DB_INIT_LOCK_PATH,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+)
 from app.utils import now_gmt7
 
+# Async drivers for the async engine, by database backend
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+
+
+def async_database_url(url: str) -> str:
+    """Same database as a sync URL, through the backend's async driver"""
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver known for {url.get_backend_name()}, set ASYNC_DATABASE_URL")
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}").render_as_string(hide_password=False)
+
+
+def engine_options(url: str) -> dict:
+    """create_engine / create_async_engine arguments for the database backend"""
+    if make_url(url).get_backend_name() == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Performance pragmas for every new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")  # Negative = KiB instead of pages
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def configure_engine(sync_engine):
+    """Hook backend specific connection setup onto an engine"""
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+    return sync_engine
+
+
 # Create database engine
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = configure_engine(create_engine(DATABASE_URL, **engine_options(DATABASE_URL)))
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine and sessions for async endpoints (never block the event loop)
+ASYNC_URL = ASYNC_DATABASE_URL or async_database_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_URL, **engine_options(ASYNC_URL))
+configure_engine(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Base class for models
 Base = declarative_base()
 
+# Face encodings are stored as raw little-endian float32 bytes (128 * 4 = 512 bytes)
+ENCODING_DTYPE = np.dtype('<f4')
+
+
+def encode_encoding(encoding_array) -> bytes:
+    """Serialize a 128-dim encoding to raw little-endian float32 bytes"""
+    return np.asarray(encoding_array, dtype=ENCODING_DTYPE).tobytes()
+
+
+def decode_encoding(blob: bytes) -> np.ndarray:
+    """Zero-copy view of raw float32 bytes as a numpy array"""
+    return np.frombuffer(blob, dtype=ENCODING_DTYPE)
+
 
 class User(Base):
     """User model - stores user information and face encodings"""
@@ -28,28 +107,64 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     code = Column(String, unique=True, nullable=False, index=True)  # MSSV/ID
-    encoding = Column(Text, nullable=True)  # JSON string of 128-dim array
+    # Lowercased name and code, kept by _set_lower: case-insensitive prefix search as an index range
+    name_lower = Column(String, nullable=True, index=True)
+    code_lower = Column(String, nullable=True, index=True)
+    # Encodings are deferred: loading users for listings never fetches them
+    encoding = deferred(Column(Text, nullable=True))  # Legacy JSON string of 128-dim array (migrated to encoding_blob)
+    encoding_blob = deferred(Column(LargeBinary, nullable=True))  # Raw little-endian float32 bytes of 128-dim array
+    has_encoding = Column(Boolean, nullable=False, default=False)  # Whether a face encoding is stored, kept by set_encoding
     image_path = Column(String, nullable=True)  # Path to user's enrollment image
     created_at = Column(DateTime, default=lambda: now_gmt7().replace(tzinfo=None))
     updated_at = Column(DateTime, default=lambda: now_gmt7().replace(tzinfo=None), onupdate=lambda: now_gmt7().replace(tzinfo=None))
     
     # Relationships
     attendances = relationship("Attendance", back_populates="user", cascade="all, delete-orphan")
+    templates = relationship(
+        "FaceTemplate", back_populates="user", cascade="all, delete-orphan", order_by="FaceTemplate.id"
+    )
+    
+    @validates("name", "code")
+    def _set_lower(self, key, value):
+        setattr(self, f"{key}_lower", value.lower() if value is not None else None)
+        return value
     
     def set_encoding(self, encoding_array):
-        """Convert numpy array to JSON string"""
+        """Store numpy array as raw float32 bytes"""
+        self.encoding = None
         if encoding_array is not None:
-            self.encoding = json.dumps(encoding_array.tolist())
+            self.encoding_blob = encode_encoding(encoding_array)
         else:
-            self.encoding = None
+            self.encoding_blob = None
+        self.has_encoding = encoding_array is not None
     
     def get_encoding(self):
-        """Convert JSON string back to numpy array"""
+        """Decode stored bytes back to a (read-only) numpy array"""
+        if self.encoding_blob:
+            return decode_encoding(self.encoding_blob)
         if self.encoding:
-            return np.array(json.loads(self.encoding))
+            # Row not migrated yet
+            return np.array(json.loads(self.encoding), dtype=ENCODING_DTYPE)
         return None
 
 
+class FaceTemplate(Base):
+    """One enrolled face encoding of a user - a user can have several (capped)"""
+    __tablename__ = "face_templates"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    encoding_blob = Column(LargeBinary, nullable=False)  # Raw little-endian float32 bytes of 128-dim array
+    created_at = Column(DateTime, default=lambda: now_gmt7().replace(tzinfo=None))
+    
+    # Relationships
+    user = relationship("User", back_populates="templates")
+    
+    def get_encoding(self):
+        """Decode stored bytes to a (read-only) numpy array"""
+        return decode_encoding(self.encoding_blob)
+
+
 class Attendance(Base):
     """Attendance record model"""
     __tablename__ = "attendance"
@@ -62,6 +177,34 @@ class Attendance(Base):
     
     # Relationships
     user = relationship("User", back_populates="attendances")
+    
+    __table_args__ = (
+        # Keyset pagination on (timestamp, id); covers every listed column so
+        # a page is read from the index alone
+        Index("ix_attendance_timestamp_id", "timestamp", "id", "user_id", "status", "device_id"),
+        # Per-user history pages
+        Index("ix_attendance_user_timestamp_id", "user_id", "timestamp", "id"),
+    )
+
+
+class AttendanceDaily(Base):
+    """Attendance counts per day / user / status, kept up to date as scans are recorded"""
+    __tablename__ = "attendance_daily"
+    
+    day = Column(Date, primary_key=True)  # GMT+7 calendar day
+    user_id = Column(Integer, primary_key=True)  # 0 for unknown faces (no NULLs in a primary key)
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class GalleryChange(Base):
+    """Append-only log of face gallery changes - its id is the gallery version"""
+    __tablename__ = "gallery_changes"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)  # No FK: deleted users must stay in the log
+    op = Column(String, nullable=False)  # 'upsert' or 'delete'
+    created_at = Column(DateTime, default=lambda: now_gmt7().replace(tzinfo=None))
 
 
 class Settings(Base):
@@ -71,6 +214,7 @@ class Settings(Base):
     id = Column(Integer, primary_key=True, index=True)
     threshold = Column(Float, default=0.4)  # Face recognition threshold (lower = more strict/accurate)
     camera_id = Column(Integer, default=0)  # Default camera device ID
+    revision = Column(Integer, nullable=False, default=0)  # Incremented by every update, orders cached copies
 
 
 class Admin(Base):
@@ -83,8 +227,27 @@ class Admin(Base):
     created_at = Column(DateTime, default=lambda: now_gmt7().replace(tzinfo=None))
 
 
+@contextmanager
+def _init_lock():
+    """Exclusive lock on DB_INIT_LOCK_PATH: other processes calling init_db wait until it is released"""
+    DB_INIT_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(DB_INIT_LOCK_PATH, "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
 def init_db():
-    """Initialize database - create all tables and migrate schema if needed"""
+    """
+    Initialize database - create all tables and migrate schema if needed.
+    Runs in one process at a time: workers starting together wait for the
+    first one, then find nothing left to do.
+    """
+    with _init_lock():
+        _create_and_migrate()
+
+
+def _create_and_migrate():
     # Create all tables
     Base.metadata.create_all(bind=engine)
     
@@ -102,6 +265,178 @@ def init_db():
                 conn.execute(text("ALTER TABLE users ADD COLUMN image_path VARCHAR"))
                 conn.commit()
                 print("Added image_path column to users table")
+        
+        # Add encoding_blob column if it doesn't exist
+        if 'encoding_blob' not in columns:
+            blob_type = LargeBinary().compile(dialect=engine.dialect)
+            with engine.connect() as conn:
+                conn.execute(text(f"ALTER TABLE users ADD COLUMN encoding_blob {blob_type}"))
+                conn.commit()
+                print("Added encoding_blob column to users table")
+        
+        # Add has_encoding column if it doesn't exist (filled in after the JSON migration below)
+        if 'has_encoding' not in columns:
+            bool_type = Boolean().compile(dialect=engine.dialect)
+            with engine.connect() as conn:
+                conn.execute(text(f"ALTER TABLE users ADD COLUMN has_encoding {bool_type} NOT NULL DEFAULT FALSE"))
+                conn.commit()
+                print("Added has_encoding column to users table")
+        
+        # Add name_lower/code_lower columns if they don't exist (filled in below)
+        for column in ('name_lower', 'code_lower'):
+            if column not in columns:
+                with engine.connect() as conn:
+                    conn.execute(text(f"ALTER TABLE users ADD COLUMN {column} VARCHAR"))
+                    conn.commit()
+                    print(f"Added {column} column to users table")
+        
+        # Plain name index: never used by the case-insensitive search, replaced by ix_users_name_lower
+        if 'ix_users_name' in [index['name'] for index in inspector.get_indexes('users')]:
+            with engine.connect() as conn:
+                conn.execute(text("DROP INDEX ix_users_name"))
+                conn.commit()
+            print("Dropped ix_users_name index")
+        
+        _migrate_json_encodings()
+        if 'has_encoding' not in columns:
+            _backfill_has_encoding()
+        _backfill_lower_keys()
+        _backfill_face_templates()
+    
+    # Add revision column to settings table if it doesn't exist
+    if 'settings' in inspector.get_table_names():
+        if 'revision' not in [col['name'] for col in inspector.get_columns('settings')]:
+            with engine.connect() as conn:
+                conn.execute(text("ALTER TABLE settings ADD COLUMN revision INTEGER NOT NULL DEFAULT 0"))
+                conn.commit()
+                print("Added revision column to settings table")
+    
+    # create_all skips indexes of tables that already exist
+    for index in (*User.__table__.indexes, *Attendance.__table__.indexes):
+        index.create(bind=engine, checkfirst=True)
+    
+    _backfill_daily_rollup()
+
+
+def _migrate_json_encodings(batch_size: int = 1000):
+    """Convert legacy JSON encodings to float32 bytes in bulk, batch by batch"""
+    from sqlalchemy import text
+    
+    migrated = 0
+    unreadable = []  # Left untouched: the JSON is the only copy of these encodings
+    last_id = 0
+    with engine.begin() as conn:
+        while True:
+            rows = conn.execute(
+                text(
+                    "SELECT id, encoding FROM users "
+                    "WHERE encoding IS NOT NULL AND encoding_blob IS NULL AND id > :after "
+                    "ORDER BY id LIMIT :limit"
+                ),
+                {"after": last_id, "limit": batch_size}
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            
+            params = []
+            for user_id, encoding_json in rows:
+                try:
+                    blob = encode_encoding(json.loads(encoding_json))
+                except (ValueError, TypeError):
+                    blob = None
+                if blob is None or len(blob) != 128 * ENCODING_DTYPE.itemsize:
+                    unreadable.append(user_id)
+                    continue
+                params.append({"id": user_id, "blob": blob})
+            
+            if params:
+                conn.execute(
+                    text("UPDATE users SET encoding_blob = :blob, encoding = NULL WHERE id = :id AND encoding_blob IS NULL"),
+                    params
+                )
+                migrated += len(params)
+    
+    if migrated:
+        print(f"Migrated {migrated} face encodings from JSON to float32 bytes")
+    if unreadable:
+        print(f"✗ Could not parse the JSON encoding of {len(unreadable)} users, left unchanged: {unreadable}")
+
+
+def _backfill_has_encoding():
+    """
+    Set the has_encoding flag of users enrolled before it existed. Keyed on
+    the converted encoding only: JSON the migration could not parse gives no
+    template and no gallery entry, so those users are not enrolled.
+    """
+    from sqlalchemy import text
+    
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            "UPDATE users SET has_encoding = TRUE WHERE encoding_blob IS NOT NULL"
+        ))
+    if result.rowcount:
+        print(f"Flagged {result.rowcount} enrolled users")
+
+
+def _backfill_lower_keys(batch_size: int = 1000):
+    """Fill name_lower/code_lower of users created before they existed (lowercased in Python, like _set_lower)"""
+    from sqlalchemy import text
+    
+    filled = 0
+    with engine.begin() as conn:
+        while True:
+            rows = conn.execute(
+                text("SELECT id, name, code FROM users WHERE name_lower IS NULL OR code_lower IS NULL LIMIT :limit"),
+                {"limit": batch_size}
+            ).fetchall()
+            if not rows:
+                break
+            conn.execute(
+                text("UPDATE users SET name_lower = :name, code_lower = :code WHERE id = :id"),
+                [{"id": user_id, "name": (name or "").lower(), "code": (code or "").lower()} for user_id, name, code in rows]
+            )
+            filled += len(rows)
+    
+    if filled:
+        print(f"Filled lowercase search keys of {filled} users")
+
+
+def _backfill_face_templates():
+    """Give every enrolled user without templates its current encoding as first template"""
+    from sqlalchemy import text
+    
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            "INSERT INTO face_templates (user_id, encoding_blob, created_at) "
+            "SELECT u.id, u.encoding_blob, COALESCE(u.updated_at, u.created_at) FROM users u "
+            "WHERE u.encoding_blob IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM face_templates t WHERE t.user_id = u.id)"
+        ))
+    
+    if result.rowcount:
+        print(f"Created {result.rowcount} face templates from existing encodings")
+
+
+def _backfill_daily_rollup():
+    """
+    Build the daily attendance rollup from existing records when it is still
+    empty. The emptiness check is part of the insert, so two processes
+    running it at once cannot both fill the table.
+    """
+    from sqlalchemy import text
+    
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            "INSERT INTO attendance_daily (day, user_id, status, count) "
+            "SELECT date(timestamp), COALESCE(user_id, 0), status, COUNT(*) FROM attendance "
+            "WHERE timestamp IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM attendance_daily) "
+            "GROUP BY date(timestamp), COALESCE(user_id, 0), status"
+        ))
+    
+    if result.rowcount:
+        print(f"Built {result.rowcount} daily attendance rollup rows from existing records")
 
 
 def get_db():
@@ -111,3 +446,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """Dependency for getting an async database session"""
+    async with AsyncSessionLocal() as db:
+        yield db
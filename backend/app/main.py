@@ -1,11 +1,20 @@
 """
 FastAPI application entry point
 """
-from fastapi import FastAPI
+import asyncio
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from app.config import CORS_ORIGINS
-from app.database import init_db
+from fastapi.responses import JSONResponse
+from app.config import CORS_ORIGINS, SCAN_WRITE_BEHIND
+from app.database import init_db, SessionLocal, async_engine
 from app.routers import auth, users, attendance, settings, websocket
+from app.routers.websocket import start_backplane, stop_backplane, push_local_settings
+from app.services.gallery_service import gallery
+from app.services.face_pool import face_pool, FacePoolOverloaded
+from app.services.presence_service import presence
+from app.services.settings_service import settings_cache
+from app.services.user_directory import user_directory
+from app.services.scan_writer import scan_writer
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -21,6 +30,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Include routers
@@ -33,9 +43,48 @@ app.include_router(websocket.router)
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database on startup"""
+    """Initialize database, load the face gallery, users, presence and settings, start face workers"""
     init_db()
     print("Database initialized")
+    
+    # Replays scans journaled before a crash, so it runs before the loads below
+    if SCAN_WRITE_BEHIND:
+        scan_writer.start()
+    
+    db = SessionLocal()
+    try:
+        gallery.load(db)
+        user_directory.load(db)
+        presence.load(db)
+        settings_cache.load(db)
+    finally:
+        db.close()
+    
+    face_pool.start()
+    await start_backplane()
+    app.state.presence_reset = asyncio.create_task(presence.run_daily_reset())
+    app.state.settings_revalidation = asyncio.create_task(settings_cache.run_revalidation(push_local_settings))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Drain queued scans, stop face processing workers and background tasks"""
+    await scan_writer.stop()
+    app.state.presence_reset.cancel()
+    app.state.settings_revalidation.cancel()
+    await stop_backplane()
+    face_pool.shutdown()
+    await async_engine.dispose()
+
+
+@app.exception_handler(FacePoolOverloaded)
+async def face_pool_overloaded_handler(request: Request, exc: FacePoolOverloaded):
+    """Face workers are saturated - ask the client to retry shortly"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Face recognition is busy, please retry shortly"},
+        headers={"Retry-After": "1"}
+    )
 
 
 @app.get("/")
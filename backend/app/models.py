@@ -2,7 +2,7 @@
 Pydantic models for request/response validation
 """
 from pydantic import BaseModel, EmailStr, validator
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 
 
@@ -38,12 +38,27 @@ class UserResponse(UserBase):
     created_at: datetime
     updated_at: datetime
     has_encoding: bool  # Whether face encoding exists
+    template_count: int = 0  # Number of enrolled face templates
     image_path: Optional[str] = None  # Path to user's enrollment image
     
     class Config:
         from_attributes = True
 
 
+class BulkEnrollResult(BaseModel):
+    file: str
+    code: str  # User code taken from the file name
+    user_id: Optional[int] = None
+    status: str  # 'enrolled', 'no_face', 'unknown_code', 'duplicate', 'not_processed'
+    detail: Optional[str] = None
+
+
+class BulkEnrollResponse(BaseModel):
+    total: int
+    summary: Dict[str, int]  # Number of files per status
+    results: List[BulkEnrollResult]
+
+
 # Attendance Models
 class AttendanceCreate(BaseModel):
     user_id: Optional[int] = None
@@ -51,6 +66,10 @@ class AttendanceCreate(BaseModel):
     device_id: Optional[str] = None
 
 
+class AttendanceBatchItem(AttendanceCreate):
+    timestamp: Optional[datetime] = None  # Capture time on the client (GMT+7 if naive), server time if omitted
+
+
 class AttendanceResponse(BaseModel):
     id: int
     user_id: Optional[int]
@@ -63,6 +82,25 @@ class AttendanceResponse(BaseModel):
         from_attributes = True
 
 
+class IdentifiedFace(BaseModel):
+    location: List[int]  # top, right, bottom, left in frame pixels
+    user_id: Optional[int] = None  # None if no gallery match within threshold
+    user_name: Optional[str] = None
+    distance: Optional[float] = None  # Distance to the closest gallery encoding
+    attendance_id: Optional[int] = None  # Set when the scan was recorded
+
+
+class FrameIdentification(BaseModel):
+    frame: int  # Index of the frame in the request
+    faces: List[IdentifiedFace]
+
+
+class IdentifyResponse(BaseModel):
+    threshold: float
+    gallery_version: int
+    frames: List[FrameIdentification]
+
+
 # Authentication Models
 class LoginRequest(BaseModel):
     username: str
@@ -1,93 +1,429 @@
 """
 Attendance router - Handle attendance records
 """
-from fastapi import APIRouter, Depends, HTTPException, Query
+import base64
+import csv
+import io
+import json
+import os
+import zlib
+from types import SimpleNamespace
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, UploadFile, File
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from typing import List, Optional
+from sqlalchemy import case, desc, func, insert, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
 from datetime import datetime, timedelta
 from app.utils import now_gmt7, utc_to_gmt7, GMT7
 
-from app.database import get_db, Attendance, User
-from app.models import AttendanceCreate, AttendanceResponse, AttendanceStats
-from app.routers.websocket import broadcast_new_attendance
+import numpy as np
+
+from app.config import MAX_IDENTIFY_FRAMES, MAX_SCAN_BATCH, EXPORT_CHUNK_SIZE
+from app.database import get_db, get_async_db, SessionLocal, Attendance, AttendanceDaily
+from app.models import (
+    AttendanceCreate, AttendanceBatchItem, AttendanceResponse, AttendanceStats,
+    IdentifiedFace, FrameIdentification, IdentifyResponse
+)
+from app.services.face_service import encode_faces_from_bytes, identify_in_gallery
+from app.services.face_pool import face_pool
+from app.routers.websocket import broadcast_attendance_record, broadcast_scan_batch
+from app.services.gallery_service import gallery, gallery_etag, GALLERY_MEDIA_TYPE
+from app.services.stats_service import record_daily_rollup_async
+from app.services.presence_service import presence
+from app.services.scan_writer import scan_writer
+from app.services.settings_service import settings_cache
+from app.services.user_directory import user_directory
 
 router = APIRouter(prefix="/api/attendance", tags=["attendance"])
 
+EXPORT_COLUMNS = ["ID", "User ID", "User Name", "Timestamp", "Status", "Device ID"]
+
 
 @router.get("/encodings")
-def get_user_encodings(db: Session = Depends(get_db)):
+def get_user_encodings(
+    request: Request,
+    response: Response,
+    since: Optional[int] = Query(None, ge=0),
+    format: Optional[str] = Query(None, pattern="^(json|binary)$"),
+    db: Session = Depends(get_db)
+):
     """
     Public endpoint to get user encodings for face recognition
-    Returns user_id, name, and encoding (for desktop clients)
+    Returns user_id, name and encoding (for desktop clients), one entry per
+    user: "encoding" is the latest face template, "encodings" all of them
+    (oldest first)
+    
+    - ETag is the gallery version and representation (JSON, binary, gzip);
+      If-None-Match answers 304 when unchanged
+    - since=<version> returns only encodings added/updated after that version
+      plus the ids of deleted users ("full" is true when a full reload is needed)
+    - Accept: application/x-face-gallery (or format=binary) returns the compact
+      binary format (see gallery_service, one row per template), gzip
+      compressed if accepted
     """
-    users = db.query(User).filter(User.encoding.isnot(None)).all()
-    
-    result = []
-    for user in users:
-        encoding = user.get_encoding()
-        if encoding is not None:
-            # Construct image URL if image exists
-            image_url = None
-            if user.image_path:
-                image_url = f"/api/users/{user.id}/image"
-            
-            result.append({
-                "user_id": user.id,
-                "name": user.name,
-                "encoding": encoding.tolist(),  # Convert numpy array to list
-                "image_path": image_url  # API endpoint for user image
-            })
-    
-    return {"encodings": result}
+    binary = _wants_binary(request, format)
+    compress = binary and "gzip" in request.headers.get("accept-encoding", "")
+    representation = ("binary-gzip" if compress else "binary") if binary else "json"
+    
+    gallery.catch_up(db)
+    etag = gallery_etag(gallery.version, representation)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    delta = gallery.changes_since(db, since)
+    snapshot = delta.snapshot
+    
+    if binary:
+        headers = {"ETag": gallery_etag(delta.version, representation), "Vary": "Accept, Accept-Encoding"}
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        elif delta.full:
+            # Stream the published snapshot file, no per-process payload copy
+            snapshot_file = gallery.open_published(delta.version)
+            if snapshot_file is not None:
+                headers["Content-Length"] = str(os.fstat(snapshot_file.fileno()).st_size)
+                return StreamingResponse(_file_chunks(snapshot_file), media_type=GALLERY_MEDIA_TYPE, headers=headers)
+        return Response(
+            content=gallery.binary_payload(delta, compress),
+            media_type=GALLERY_MEDIA_TYPE,
+            headers=headers
+        )
+    
+    # Convert the selected rows at once instead of one array per user
+    encodings = snapshot.encodings[delta.rows].tolist()
+    
+    # Rows of a user are contiguous, oldest template first
+    entries = {}
+    for row, encoding in zip(delta.rows, encodings):
+        user_id = int(snapshot.user_ids[row])
+        entry = entries.get(user_id)
+        if entry is None:
+            entry = entries[user_id] = {
+                "user_id": user_id,
+                "name": snapshot.names[row],
+                "encoding": None,
+                "encodings": [],
+                "image_path": snapshot.image_paths[row]  # API endpoint for user image
+            }
+        entry["encoding"] = encoding
+        entry["encodings"].append(encoding)
+    result = list(entries.values())
+    
+    response.headers["ETag"] = gallery_etag(delta.version, representation)
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    return {
+        "encodings": result,
+        "deleted": delta.deleted,
+        "version": delta.version,
+        "full": delta.full
+    }
+
+
+def _file_chunks(f: BinaryIO, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """Read an open file in chunks, closing it at the end"""
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _wants_binary(request: Request, format: Optional[str]) -> bool:
+    """Content negotiation for the encodings endpoint"""
+    if format is not None:
+        return format == "binary"
+    return GALLERY_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def _store_scans(db: AsyncSession, scans: List[dict]) -> list:
+    """
+    Persist new scans (dicts of Attendance columns) with their daily rollup,
+    returning rows with their ids in the same order - committed right away,
+    or queued for the next group commit in write-behind mode
+    """
+    if not scans:
+        return []
+    if scan_writer.enabled:
+        return [SimpleNamespace(**row) for row in scan_writer.submit(scans)]
+    
+    result = await db.execute(
+        insert(Attendance).returning(
+            Attendance.id,
+            Attendance.user_id,
+            Attendance.timestamp,
+            Attendance.status,
+            Attendance.device_id,
+            sort_by_parameter_order=True
+        ),
+        scans
+    )
+    rows = result.all()
+    await record_daily_rollup_async(db, rows)
+    await db.commit()
+    return rows
+
+
+async def _scan_responses(db: AsyncSession, rows: list) -> List[AttendanceResponse]:
+    """Attendance responses for stored scans, user names from the user directory"""
+    await user_directory.fetch_missing_async(db, (row.user_id for row in rows))
+    return [
+        AttendanceResponse(
+            id=row.id,
+            user_id=row.user_id,
+            timestamp=row.timestamp.replace(tzinfo=GMT7),
+            status=row.status,
+            device_id=row.device_id,
+            user_name=user_directory.name(row.user_id)
+        )
+        for row in rows
+    ]
+
+
+def _catch_up_gallery():
+    """Apply gallery changes made by other processes (sync session, run off the event loop)"""
+    db = SessionLocal()
+    try:
+        gallery.catch_up(db)
+    finally:
+        db.close()
 
 
 @router.post("/scan", response_model=AttendanceResponse, status_code=201)
-async def record_scan(scan_data: AttendanceCreate, db: Session = Depends(get_db)):
+async def record_scan(scan_data: AttendanceCreate, db: AsyncSession = Depends(get_async_db)):
     """
     Record a face scan result from desktop client
     """
     # Create attendance record (store in GMT+7)
-    attendance = Attendance(
-        user_id=scan_data.user_id,
-        timestamp=now_gmt7(),
-        status=scan_data.status,
-        device_id=scan_data.device_id
-    )
+    rows = await _store_scans(db, [{
+        "user_id": scan_data.user_id,
+        "timestamp": now_gmt7().replace(tzinfo=None),
+        "status": scan_data.status,
+        "device_id": scan_data.device_id
+    }])
+    attendance = (await _scan_responses(db, rows))[0]
+    
+    # Broadcast to WebSocket clients
+    await broadcast_attendance_record(attendance)
+    
+    return attendance
+
+
+def _scan_timestamp(timestamp: Optional[datetime], now: datetime) -> datetime:
+    """Naive GMT+7 storage time of a client scan time, never later than now"""
+    if timestamp is None:
+        timestamp = now
+    elif timestamp.tzinfo is None:
+        # Assume GMT+7 if no timezone info
+        timestamp = timestamp.replace(tzinfo=GMT7)
+    return min(timestamp, now).astimezone(GMT7).replace(tzinfo=None)
+
+
+@router.post("/scan/batch", response_model=List[AttendanceResponse], status_code=201)
+async def record_scan_batch(scans: List[AttendanceBatchItem], db: AsyncSession = Depends(get_async_db)):
+    """
+    Record many face scans at once, e.g. a kiosk replaying scans buffered
+    while offline
     
-    db.add(attendance)
-    db.commit()
-    db.refresh(attendance)
+    - Client timestamps are kept (clamped to the server time)
+    - One bulk INSERT ... RETURNING in one transaction
+    - One aggregated 'attendance_batch' WebSocket message
+    """
+    if len(scans) > MAX_SCAN_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SCAN_BATCH} scans per batch")
+    if not scans:
+        return []
+    
+    now = now_gmt7()
+    rows = await _store_scans(db, [
+        {
+            "user_id": scan.user_id,
+            "timestamp": _scan_timestamp(scan.timestamp, now),
+            "status": scan.status,
+            "device_id": scan.device_id
+        }
+        for scan in scans
+    ])
+    result = await _scan_responses(db, rows)
     
     # Broadcast to WebSocket clients
-    await broadcast_new_attendance(attendance.id, db)
+    await broadcast_scan_batch(result)
+    
+    return result
+
+
+@router.post("/identify", response_model=IdentifyResponse)
+async def identify_faces(
+    files: List[UploadFile] = File(...),
+    record: bool = Query(False),
+    device_id: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Identify every face in a batch of frames on the server (for thin clients)
+    
+    Each frame is detected and encoded once for all its faces, then all
+    encodings of the batch are matched against the gallery in one matrix
+    operation. With record=true a scan is recorded for each face found.
+    """
+    if len(files) > MAX_IDENTIFY_FRAMES:
+        raise HTTPException(status_code=400, detail=f"Too many frames (max {MAX_IDENTIFY_FRAMES})")
+    
+    frames_bytes = []
+    for file in files:
+        image_bytes = await file.read()
+        if not image_bytes:
+            raise HTTPException(status_code=400, detail=f"Empty file: {file.filename}")
+        frames_bytes.append(image_bytes)
+    
+    # Detect + encode per frame, frames in parallel across face workers
+    frame_results = await face_pool.map(encode_faces_from_bytes, [(image_bytes,) for image_bytes in frames_bytes])
+    
+    # Match all faces of all frames at once
+    threshold = settings_cache.get().threshold
+    await run_in_threadpool(_catch_up_gallery)
+    snapshot = gallery.snapshot()
+    all_encodings = np.concatenate([encodings for _, encodings in frame_results])
+    best_rows, best_distances, matched = identify_in_gallery(
+        all_encodings, snapshot, threshold, gallery.ann_index(snapshot)
+    )
+    
+    frames = []
+    position = 0
+    for frame_index, (locations, _) in enumerate(frame_results):
+        faces = []
+        for location in locations:
+            face = IdentifiedFace(location=list(location))
+            if np.isfinite(best_distances[position]):
+                face.distance = float(best_distances[position])
+            if matched[position]:
+                row = int(best_rows[position])
+                face.user_id = int(snapshot.user_ids[row])
+                face.user_name = snapshot.names[row]
+            faces.append(face)
+            position += 1
+        frames.append(FrameIdentification(frame=frame_index, faces=faces))
+    
+    if record:
+        # One transaction for every face of the batch
+        faces = [face for frame in frames for face in frame.faces]
+        timestamp = now_gmt7().replace(tzinfo=None)
+        rows = await _store_scans(db, [
+            {
+                "user_id": face.user_id,
+                "timestamp": timestamp,
+                "status": 'success' if face.user_id is not None else 'unknown',
+                "device_id": device_id
+            }
+            for face in faces
+        ])
+        
+        for face, attendance in zip(faces, await _scan_responses(db, rows)):
+            face.attendance_id = attendance.id
+            await broadcast_attendance_record(attendance)
+    
+    return IdentifyResponse(threshold=threshold, gallery_version=snapshot.version, frames=frames)
+
+
+def _parse_date_filter(value: str, end_of_day: bool = False) -> Optional[datetime]:
+    """Parse a YYYY-MM-DD (GMT+7) or ISO date filter, None if invalid"""
+    try:
+        # Handle date format YYYY-MM-DD (assume GMT+7 timezone)
+        if len(value) == 10:  # YYYY-MM-DD format
+            parsed = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=GMT7)
+            if end_of_day:
+                # Add time 23:59:59 to include the whole day in GMT+7
+                parsed = parsed.replace(hour=23, minute=59, second=59)
+            return parsed
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (ValueError, AttributeError) as e:
+        print(f"Error parsing date filter {value!r}: {e}")
+        return None
+
+
+def attendance_list_query(db: Session):
+    """
+    Attendance columns for list responses - all in the covering timestamp
+    index; user names come from the user directory, not a join
+    """
+    return db.query(
+        Attendance.id,
+        Attendance.user_id,
+        Attendance.timestamp,
+        Attendance.status,
+        Attendance.device_id
+    )
+
+
+def filter_attendance(
+    query,
+    user_id: Optional[int] = None,
+    status: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+):
+    """Apply the attendance list filters to a query over Attendance"""
+    if user_id:
+        query = query.filter(Attendance.user_id == user_id)
     
-    # Get user name if user_id exists
-    user_name = None
-    if attendance.user_id:
-        user = db.query(User).filter(User.id == attendance.user_id).first()
-        if user:
-            user_name = user.name
+    if status:
+        query = query.filter(Attendance.status == status)
+    
+    if start_date:
+        start_dt = _parse_date_filter(start_date)
+        if start_dt is not None:
+            query = query.filter(Attendance.timestamp >= start_dt)
+    
+    if end_date:
+        end_dt = _parse_date_filter(end_date, end_of_day=True)
+        if end_dt is not None:
+            query = query.filter(Attendance.timestamp <= end_dt)
     
+    return query
+
+
+def encode_cursor(timestamp: datetime, attendance_id: int) -> str:
+    """Opaque keyset cursor for the row (timestamp, id) a page ended on"""
+    raw = f"{timestamp.replace(tzinfo=None).isoformat()}|{attendance_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor, 400 on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, attendance_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(attendance_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def attendance_to_response(row) -> AttendanceResponse:
+    """Build the response for a row of attendance columns"""
     # Ensure timestamp is timezone-aware (GMT+7)
-    timestamp = attendance.timestamp
+    timestamp = row.timestamp
     if timestamp and timestamp.tzinfo is None:
+        # Assume stored datetime is GMT+7 (naive), make it timezone-aware
         timestamp = timestamp.replace(tzinfo=GMT7)
     
     return AttendanceResponse(
-        id=attendance.id,
-        user_id=attendance.user_id,
+        id=row.id,
+        user_id=row.user_id,
         timestamp=timestamp,
-        status=attendance.status,
-        device_id=attendance.device_id,
-        user_name=user_name
+        status=row.status,
+        device_id=row.device_id,
+        user_name=user_directory.name(row.user_id)
     )
 
 
 @router.get("", response_model=List[AttendanceResponse])
 def get_attendance(
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=50000),  # Increased limit for reports export
+    cursor: Optional[str] = None,
     user_id: Optional[int] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
@@ -95,72 +431,145 @@ def get_attendance(
     db: Session = Depends(get_db)
 ):
     """
-    Get attendance records with optional filters
+    Get attendance records with optional filters, newest first
+    
+    - User names come from the in-memory user directory, so the query
+      reads only the covering timestamp index
+    - Keyset pagination: pass the X-Next-Cursor header of a page as `cursor`
+      to get the next one (the header is absent on the last page). `skip`
+      still works but gets slower the deeper it goes and is ignored when a
+      cursor is given
     """
-    query = db.query(Attendance)
+    query = attendance_list_query(db)
     
     # Apply filters
-    if user_id:
-        query = query.filter(Attendance.user_id == user_id)
+    query = filter_attendance(query, user_id, status, start_date, end_date)
     
-    if status:
-        query = query.filter(Attendance.status == status)
+    if cursor:
+        cursor_timestamp, cursor_id = decode_cursor(cursor)
+        query = query.filter(
+            tuple_(Attendance.timestamp, Attendance.id) < tuple_(cursor_timestamp, cursor_id)
+        )
+    elif skip:
+        query = query.offset(skip)
     
-    if start_date:
-        try:
-            # Handle date format YYYY-MM-DD (assume GMT+7 timezone)
-            if len(start_date) == 10:  # YYYY-MM-DD format
-                from app.utils import GMT7
-                start_dt = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=GMT7)
-            else:
-                start_dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-            query = query.filter(Attendance.timestamp >= start_dt)
-        except (ValueError, AttributeError) as e:
-            print(f"Error parsing start_date: {e}")
-            pass
+    # Order by timestamp descending, id breaks ties so pages never overlap
+    rows = query.order_by(desc(Attendance.timestamp), desc(Attendance.id)).limit(limit).all()
+    user_directory.fetch_missing(db, (row.user_id for row in rows))
     
-    if end_date:
-        try:
-            # Handle date format YYYY-MM-DD (assume GMT+7 timezone)
-            if len(end_date) == 10:  # YYYY-MM-DD format
-                from app.utils import GMT7
-                # Add time 23:59:59 to include the whole day in GMT+7
-                end_dt = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=GMT7)
-            else:
-                end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-            query = query.filter(Attendance.timestamp <= end_dt)
-        except (ValueError, AttributeError) as e:
-            print(f"Error parsing end_date: {e}")
-            pass
-    
-    # Order by timestamp descending
-    attendances = query.order_by(desc(Attendance.timestamp)).offset(skip).limit(limit).all()
-    
-    # Build response with user names
-    result = []
-    for att in attendances:
-        user_name = None
-        if att.user_id:
-            user = db.query(User).filter(User.id == att.user_id).first()
-            if user:
-                user_name = user.name
-        
-        # Ensure timestamp is timezone-aware (GMT+7)
-        timestamp = att.timestamp
-        if timestamp and timestamp.tzinfo is None:
-            # Assume stored datetime is GMT+7 (naive), make it timezone-aware
-            timestamp = timestamp.replace(tzinfo=GMT7)
-        
-        result.append(AttendanceResponse(
-            id=att.id,
-            user_id=att.user_id,
-            timestamp=timestamp,
-            status=att.status,
-            device_id=att.device_id,
-            user_name=user_name
-        ))
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].timestamp, rows[-1].id)
     
-    return result
+    return [attendance_to_response(row) for row in rows]
+
+
+def _export_rows(
+    user_id: Optional[int],
+    status: Optional[str],
+    start_date: Optional[str],
+    end_date: Optional[str]
+) -> Iterator:
+    """
+    Stream filtered attendance rows from a server-side cursor, EXPORT_CHUNK_SIZE
+    at a time. Uses its own session: the generator outlives the request scope.
+    """
+    db = SessionLocal()
+    try:
+        query = attendance_list_query(db)
+        query = filter_attendance(query, user_id, status, start_date, end_date)
+        query = query.order_by(desc(Attendance.timestamp), desc(Attendance.id))
+        result = db.execute(query.statement, execution_options={"yield_per": EXPORT_CHUNK_SIZE})
+        for chunk in result.partitions():
+            user_directory.fetch_missing(db, (row.user_id for row in chunk))
+            yield from chunk
+    finally:
+        db.close()
+
+
+def _csv_chunks(rows: Iterable) -> Iterator[str]:
+    """CSV text, one chunk per EXPORT_CHUNK_SIZE rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([
+            row.id,
+            row.user_id if row.user_id is not None else "",
+            user_directory.name(row.user_id) or "",
+            row.timestamp.replace(tzinfo=GMT7).isoformat() if row.timestamp else "",
+            row.status,
+            row.device_id or ""
+        ])
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _ndjson_chunks(rows: Iterable) -> Iterator[str]:
+    """One JSON object per line, one chunk per EXPORT_CHUNK_SIZE rows"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({
+            "id": row.id,
+            "user_id": row.user_id,
+            "user_name": user_directory.name(row.user_id),
+            "timestamp": row.timestamp.replace(tzinfo=GMT7).isoformat() if row.timestamp else None,
+            "status": row.status,
+            "device_id": row.device_id
+        }, ensure_ascii=False))
+        if len(lines) == EXPORT_CHUNK_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _encode_chunks(chunks: Iterable[str], compress: bool) -> Iterator[bytes]:
+    """UTF-8 encode text chunks, gzip compressing them as a single stream if asked"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip container
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+@router.get("/export")
+def export_attendance(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    user_id: Optional[int] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None
+):
+    """
+    Export attendance records as CSV or NDJSON, newest first
+    
+    - Same filters as GET /api/attendance, without a row limit
+    - Rows are streamed from a server-side cursor in chunks, so memory stays
+      constant whatever the number of rows
+    - gzip compressed if the client accepts it
+    """
+    rows = _export_rows(user_id, status, start_date, end_date)
+    chunks = _csv_chunks(rows) if format == "csv" else _ndjson_chunks(rows)
+    compress = "gzip" in request.headers.get("accept-encoding", "")
+    
+    filename = f"attendance_{start_date or 'all'}_{end_date or 'all'}.{format}"
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Vary": "Accept-Encoding"
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(_encode_chunks(chunks, compress), media_type=media_type, headers=headers)
 
 
 @router.get("/stats", response_model=AttendanceStats)
@@ -169,103 +578,39 @@ def get_stats(
 ):
     """
     Get attendance statistics
+    
+    Totals come from the daily rollup and today's check-ins from the presence
+    tracker, so the cost does not grow with the number of attendance records
     """
-    now = now_gmt7()
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    # Convert to naive datetime for database comparison (timestamp is stored as naive)
-    today_start_naive = today_start.replace(tzinfo=None)
-    week_start_naive = (today_start - timedelta(days=now.weekday())).replace(tzinfo=None)
-    month_start_naive = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).replace(tzinfo=None)
-    
-    # Count today (all records)
-    total_today = db.query(Attendance).filter(Attendance.timestamp >= today_start_naive).count()
-    
-    # Count this week
-    total_this_week = db.query(Attendance).filter(Attendance.timestamp >= week_start_naive).count()
-    
-    # Count this month
-    total_this_month = db.query(Attendance).filter(Attendance.timestamp >= month_start_naive).count()
-    
-    # Get total number of users
-    total_users = db.query(User).count()
-    
-    # Count unique users who checked in today (status='success' and user_id is not None)
-    # Get all attendance records for today with success status
-    # Also filter by today's date (not just >= today_start) to ensure we only count today
-    today_end_naive = today_start_naive.replace(hour=23, minute=59, second=59, microsecond=999999)
-    
-    today_attendances = db.query(Attendance).filter(
-        Attendance.timestamp >= today_start_naive,
-        Attendance.timestamp <= today_end_naive,
-        Attendance.status == 'success',
-        Attendance.user_id.isnot(None)
-    ).all()
-    
-    # Get unique user_ids and user names from today's successful attendances
-    unique_user_ids = set()
-    checked_in_user_names = []
-    user_id_to_name = {}
-    
-    for att in today_attendances:
-        if att.user_id is not None:
-            unique_user_ids.add(att.user_id)
-            # Get user name if not already cached
-            if att.user_id not in user_id_to_name:
-                user = db.query(User).filter(User.id == att.user_id).first()
-                if user:
-                    user_id_to_name[att.user_id] = user.name
-    
-    # Build list of checked-in user names
-    for user_id in unique_user_ids:
-        if user_id in user_id_to_name:
-            checked_in_user_names.append(user_id_to_name[user_id])
-    
-    checked_in_today = len(unique_user_ids)
-    
-    # Get list of users who have NOT checked in today
-    all_users = db.query(User).all()
-    checked_in_user_ids_set = unique_user_ids
-    not_checked_in_user_names = []
-    
-    for user in all_users:
-        if user.id not in checked_in_user_ids_set:
-            not_checked_in_user_names.append(user.name)
-    
-    # Sort alphabetically
-    not_checked_in_user_names.sort()
+    today = now_gmt7().date()
+    week_start = today - timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    
+    # Today / week / month totals in one grouped scan of the rollup
+    total_today, total_this_week, total_this_month = db.query(
+        func.coalesce(func.sum(case((AttendanceDaily.day >= today, AttendanceDaily.count), else_=0)), 0),
+        func.coalesce(func.sum(case((AttendanceDaily.day >= week_start, AttendanceDaily.count), else_=0)), 0),
+        func.coalesce(func.sum(case((AttendanceDaily.day >= month_start, AttendanceDaily.count), else_=0)), 0)
+    ).filter(AttendanceDaily.day >= min(week_start, month_start)).one()
+    
+    # Who is in / who is not, from the live presence tracker
+    if presence.day != today:
+        presence.load(db, today)
+    checked_in_user_names, not_checked_in_user_names = presence.name_lists()
     
     # Get recent scans (last 10)
-    recent_attendances = db.query(Attendance).order_by(desc(Attendance.timestamp)).limit(10).all()
-    
-    recent_scans = []
-    for att in recent_attendances:
-        user_name = None
-        if att.user_id:
-            user = db.query(User).filter(User.id == att.user_id).first()
-            if user:
-                user_name = user.name
-        
-        # Ensure timestamp is timezone-aware (GMT+7)
-        timestamp = att.timestamp
-        if timestamp and timestamp.tzinfo is None:
-            timestamp = timestamp.replace(tzinfo=GMT7)
-        
-        recent_scans.append(AttendanceResponse(
-            id=att.id,
-            user_id=att.user_id,
-            timestamp=timestamp,
-            status=att.status,
-            device_id=att.device_id,
-            user_name=user_name
-        ))
+    recent_rows = attendance_list_query(db).order_by(
+        desc(Attendance.timestamp), desc(Attendance.id)
+    ).limit(10).all()
+    user_directory.fetch_missing(db, (row.user_id for row in recent_rows))
     
     return AttendanceStats(
         total_today=total_today,
         total_this_week=total_this_week,
         total_this_month=total_this_month,
-        total_users=total_users,
-        checked_in_today=checked_in_today,
+        total_users=presence.total_users,
+        checked_in_today=len(checked_in_user_names),
         checked_in_users=checked_in_user_names,
         not_checked_in_users=not_checked_in_user_names,
-        recent_scans=recent_scans
+        recent_scans=[attendance_to_response(row) for row in recent_rows]
     )
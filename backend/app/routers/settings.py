@@ -1,85 +1,71 @@
 """
 Settings router - System configuration
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from app.database import get_db, Settings
 from app.models import SettingsResponse, SettingsUpdate
 from app.dependencies import get_current_user
-from fastapi import Depends
+from app.routers.websocket import manager
+from app.services.settings_service import settings_cache, settings_etag, to_system_settings
 
 router = APIRouter(prefix="/api/settings", tags=["settings"])
 
 
 @router.get("", response_model=SettingsResponse)
-def get_settings(
-    db: Session = Depends(get_db),
-    current_user: str = Depends(get_current_user)
-):
+def get_settings(current_user: str = Depends(get_current_user)):
     """Get system settings (requires authentication)"""
-    settings = db.query(Settings).first()
-    
-    # Create default settings if none exist
-    if not settings:
-        settings = Settings(threshold=0.6, camera_id=0)
-        db.add(settings)
-        db.commit()
-        db.refresh(settings)
-    
-    return SettingsResponse(
-        id=settings.id,
-        threshold=settings.threshold,
-        camera_id=settings.camera_id
-    )
+    return SettingsResponse(**settings_cache.get()._asdict())
 
 
 @router.get("/public", response_model=SettingsResponse)
-def get_settings_public(db: Session = Depends(get_db)):
+def get_settings_public(request: Request, response: Response):
     """
     Public endpoint to get system settings (for desktop clients)
     Returns only threshold setting needed for face recognition
-    """
-    settings = db.query(Settings).first()
     
-    # Create default settings if none exist
-    if not settings:
-        settings = Settings(threshold=0.6, camera_id=0)
-        db.add(settings)
-        db.commit()
-        db.refresh(settings)
+    - Served from memory; ETag / If-None-Match answers 304 when unchanged
+    - Updates are also pushed as "settings" messages on WS /ws, so clients
+      listening there do not need to poll
+    """
+    settings = settings_cache.get()
+    etag = settings_etag(settings)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     
-    return SettingsResponse(
-        id=settings.id,
-        threshold=settings.threshold,
-        camera_id=settings.camera_id
-    )
+    response.headers["ETag"] = etag
+    return SettingsResponse(**settings._asdict())
 
 
 @router.put("", response_model=SettingsResponse)
-def update_settings(
+async def update_settings(
     settings_update: SettingsUpdate, 
     db: Session = Depends(get_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Update system settings"""
-    settings = db.query(Settings).first()
-    
-    if not settings:
-        settings = Settings()
-        db.add(settings)
-    
-    if settings_update.threshold is not None:
-        settings.threshold = settings_update.threshold
-    
-    if settings_update.camera_id is not None:
-        settings.camera_id = settings_update.camera_id
+    """Update system settings and push them to connected clients"""
+    def store():
+        settings = db.query(Settings).first()
+        
+        if not settings:
+            settings = Settings()
+            db.add(settings)
+        
+        if settings_update.threshold is not None:
+            settings.threshold = settings_update.threshold
+        
+        if settings_update.camera_id is not None:
+            settings.camera_id = settings_update.camera_id
+        
+        # Incremented in SQL so concurrent updates from several processes get distinct revisions
+        settings.revision = Settings.revision + 1 if settings.id is not None else 1
+        db.commit()
+        db.refresh(settings)
+        return to_system_settings(settings)
     
-    db.commit()
-    db.refresh(settings)
+    settings = settings_cache.set(await run_in_threadpool(store))
+    await manager.broadcast_settings(settings._asdict())
     
-    return SettingsResponse(
-        id=settings.id,
-        threshold=settings.threshold,
-        camera_id=settings.camera_id
-    )
+    return SettingsResponse(**settings._asdict())
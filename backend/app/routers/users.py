@@ -1,33 +1,100 @@
 """
 Users router - CRUD operations for users
 """
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Query, status, UploadFile, File, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy import and_, func, or_
+from typing import List, Dict, Optional
+import zipfile
 from datetime import datetime
 from app.utils import now_gmt7
 import json
 import numpy as np
 
-from app.database import get_db, User
-from app.models import UserCreate, UserUpdate, UserResponse
-from app.services.face_service import extract_encoding_from_bytes
+from app.database import get_db, User, FaceTemplate
+from app.models import UserCreate, UserUpdate, UserResponse, BulkEnrollResponse, BulkEnrollResult
+from app.services.face_service import extract_encoding_with_timings, extract_encoding_from_bytes
+from app.services.face_pool import face_pool, FacePoolOverloaded
+from app.services.gallery_service import gallery, record_gallery_change, CHANGE_UPSERT, CHANGE_DELETE
+from app.services.stats_service import remove_user_rollup
+from app.services.presence_service import presence
+from app.services.user_directory import user_directory
+from app.routers.websocket import share_user_change, share_user_deletion
+from app.services.enrollment_service import (
+    store_enrollment, commit_enrollments, apply_to_gallery, zip_image_entries, read_zip_images,
+    commit_bulk_batch, not_processed_results, summarize_results, STATUS_ENROLLED
+)
 from app.dependencies import get_current_user
-from app.config import USER_IMAGES_DIR
+from app.config import USER_IMAGES_DIR, BULK_ENROLL_BATCH_SIZE, BULK_ENROLL_WAIT_TIMEOUT
 from pathlib import Path
 
 router = APIRouter(prefix="/api/users", tags=["users"])
 
 
+def _sync_directory(db_user: User):
+    """Mirror a committed user into the user directory of every server process"""
+    user_directory.set(db_user.id, db_user.name, db_user.code, db_user.has_encoding)
+    share_user_change(db_user.id)
+
+
+def _template_counts(db: Session, user_ids: List[int]) -> Dict[int, int]:
+    """Number of face templates per user, in one grouped query"""
+    rows = (
+        db.query(FaceTemplate.user_id, func.count(FaceTemplate.id))
+        .filter(FaceTemplate.user_id.in_(user_ids))
+        .group_by(FaceTemplate.user_id)
+        .all()
+    )
+    return dict(rows)
+
+
+def _prefix_range(column, prefix: str):
+    """column starts with prefix, as a range an index on column can seek"""
+    upper = prefix[:-1] + chr(min(ord(prefix[-1]) + 1, 0x10FFFF))
+    return and_(column >= prefix, column < upper)
+
+
+MAX_USERS_PAGE = 1000  # Larger limits are clamped rather than rejected
+
+
 @router.get("", response_model=List[UserResponse])
 def get_users(
-    skip: int = 0, 
-    limit: int = 100, 
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100),
+    cursor: Optional[int] = Query(None, ge=0),
+    q: Optional[str] = Query(None, min_length=1, max_length=100),
     db: Session = Depends(get_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Get list of all users"""
-    users = db.query(User).offset(skip).limit(limit).all()
+    """
+    Get users, ordered by id
+    
+    - q: case-insensitive prefix search on name or code (index range scans
+      on the lowercased columns)
+    - Keyset pagination: pass the X-Next-Cursor header of a page as `cursor`
+      to get the next one (the header is absent on the last page); `skip`
+      still works but is ignored when a cursor is given
+    - limit is clamped to 1..MAX_USERS_PAGE; callers asking for more get a
+      full page and X-Next-Cursor for the rest
+    - Encodings are never loaded, has_encoding is a stored flag
+    """
+    limit = min(max(limit, 1), MAX_USERS_PAGE)
+    query = db.query(User)
+    if q:
+        prefix = q.lower()
+        query = query.filter(or_(_prefix_range(User.name_lower, prefix), _prefix_range(User.code_lower, prefix)))
+    if cursor is not None:
+        query = query.filter(User.id > cursor)
+    elif skip:
+        query = query.offset(skip)
+    
+    users = query.order_by(User.id).limit(limit).all()
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = str(users[-1].id)
+    
+    template_counts = _template_counts(db, [user.id for user in users])
     return [
         UserResponse(
             id=user.id,
@@ -35,7 +102,8 @@ def get_users(
             code=user.code,
             created_at=user.created_at,
             updated_at=user.updated_at,
-            has_encoding=user.encoding is not None,
+            has_encoding=user.has_encoding,
+            template_count=template_counts.get(user.id, 0),
             image_path=f"/api/users/{user.id}/image" if user.image_path else None
         )
         for user in users
@@ -59,7 +127,8 @@ def get_user(
         code=user.code,
         created_at=user.created_at,
         updated_at=user.updated_at,
-        has_encoding=user.encoding is not None,
+        has_encoding=user.has_encoding,
+        template_count=_template_counts(db, [user.id]).get(user.id, 0),
         image_path=f"/api/users/{user.id}/image" if user.image_path else None
     )
 
@@ -81,6 +150,7 @@ def create_user(
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    _sync_directory(db_user)
     
     return UserResponse(
         id=db_user.id,
@@ -118,16 +188,28 @@ def update_user(
         db_user.code = user_update.code
     
     db_user.updated_at = datetime.utcnow()
+    
+    # Name is part of the gallery, log the change for delta sync
+    version = None
+    if db_user.has_encoding and user_update.name is not None:
+        version = record_gallery_change(db, db_user.id, CHANGE_UPSERT)
+    
     db.commit()
     db.refresh(db_user)
     
+    # Keep the in-memory gallery and user directory in sync
+    if version is not None:
+        gallery.rename(db_user.id, db_user.name, version)
+    _sync_directory(db_user)
+    
     return UserResponse(
         id=db_user.id,
         name=db_user.name,
         code=db_user.code,
         created_at=db_user.created_at,
         updated_at=db_user.updated_at,
-        has_encoding=db_user.encoding is not None,
+        has_encoding=db_user.has_encoding,
+        template_count=_template_counts(db, [db_user.id]).get(db_user.id, 0),
         image_path=f"/api/users/{db_user.id}/image" if db_user.image_path else None
     )
 
@@ -143,8 +225,19 @@ def delete_user(
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    version = None
+    if db_user.has_encoding:
+        version = record_gallery_change(db, user_id, CHANGE_DELETE)
+    
+    remove_user_rollup(db, user_id)
     db.delete(db_user)
     db.commit()
+    
+    if version is not None:
+        gallery.remove(user_id, version)
+    user_directory.remove(user_id)
+    presence.remove_user(user_id)
+    share_user_deletion(user_id)
     return None
 
 
@@ -170,15 +263,21 @@ def get_user_image(user_id: int, db: Session = Depends(get_db)):
 
 
 @router.post("/{user_id}/enroll", response_model=UserResponse)
-def enroll_face(
+async def enroll_face(
     user_id: int, 
+    response: Response,
     file: UploadFile = File(...), 
+    replace: bool = False,
     db: Session = Depends(get_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Enroll user's face - upload image and extract encoding"""
+    """
+    Enroll user's face - upload image and extract encoding
+    The encoding is added as a new face template (replace=true drops the previous ones)
+    """
     try:
-        db_user = db.query(User).filter(User.id == user_id).first()
+        # Sync session: database work runs in the threadpool, off the event loop
+        db_user = await run_in_threadpool(db.get, User, user_id)
         if not db_user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -187,15 +286,20 @@ def enroll_face(
             raise HTTPException(status_code=400, detail="No file provided")
         
         # Read image bytes
-        image_bytes = file.file.read()
+        image_bytes = await file.read()
         
         if not image_bytes or len(image_bytes) == 0:
             raise HTTPException(status_code=400, detail="Empty file")
         
         print(f"Received file: {file.filename}, size: {len(image_bytes)} bytes, content_type: {file.content_type}")
         
-        # Extract face encoding
-        encoding = extract_encoding_from_bytes(image_bytes)
+        # Extract face encoding in a face worker process
+        encoding, timings = await face_pool.run(extract_encoding_with_timings, image_bytes)
+        
+        # Expose per-stage detection timings to the caller
+        response.headers["Server-Timing"] = ", ".join(
+            f"{stage};dur={duration:.1f}" for stage, duration in timings.items()
+        )
         
         if encoding is None:
             raise HTTPException(
@@ -207,28 +311,17 @@ def enroll_face(
                        "- Ảnh có độ phân giải đủ (tối thiểu 200x200 pixels)"
             )
         
-        # Save image to file system
-        image_filename = f"user_{user_id}_{int(now_gmt7().timestamp())}.jpg"
-        image_path = USER_IMAGES_DIR / image_filename
-        
-        # Delete old image if exists
-        if db_user.image_path:
-            # Extract filename from old path
-            old_filename = Path(db_user.image_path).name
-            old_image_path = USER_IMAGES_DIR / old_filename
-            if old_image_path.exists():
-                old_image_path.unlink()
+        def store():
+            update = store_enrollment(db, db_user, image_bytes, encoding, replace=replace)
+            commit_enrollments(db, [update])
+            db.refresh(db_user)
+            return update
         
-        # Save new image
-        with open(image_path, "wb") as f:
-            f.write(image_bytes)
+        update = await run_in_threadpool(store)
         
-        # Store encoding and image path (relative path for API endpoint)
-        db_user.set_encoding(encoding)
-        db_user.image_path = image_filename  # Store filename only
-        db_user.updated_at = now_gmt7()
-        db.commit()
-        db.refresh(db_user)
+        # Keep the in-memory gallery and user directory in sync
+        apply_to_gallery(update)
+        _sync_directory(db_user)
         
         return UserResponse(
             id=db_user.id,
@@ -237,12 +330,88 @@ def enroll_face(
             created_at=db_user.created_at,
             updated_at=db_user.updated_at,
             has_encoding=True,
+            template_count=len(update.encodings),
             image_path=f"/api/users/{db_user.id}/image" if db_user.image_path else None
         )
-    except HTTPException:
+    except (HTTPException, FacePoolOverloaded):
         raise
     except Exception as e:
         print(f"Error in enroll_face: {type(e).__name__}: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
+@router.post("/bulk-enroll", response_model=BulkEnrollResponse)
+async def bulk_enroll(
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: str = Depends(get_current_user)
+):
+    """
+    Enroll many users from a ZIP archive of images named by user code
+    (e.g. 20201234.jpg). Images are encoded in parallel across face workers
+    and committed in batches; returns a per-file report.
+    
+    The upload only ever uses a quarter of the face pool queue, so enrollment
+    and identification requests keep being served meanwhile. If the workers
+    stay busy for BULK_ENROLL_WAIT_TIMEOUT, the remaining files are reported
+    as 'not_processed'.
+    """
+    try:
+        archive = await run_in_threadpool(zipfile.ZipFile, file.file)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="File is not a valid ZIP archive")
+    
+    with archive:
+        try:
+            entries = zip_image_entries(archive)
+        except ValueError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        
+        chunk_size = max(1, face_pool.queue_limit // 4)
+        results = []
+        seen_codes = set()
+        batch = []
+        
+        async def commit(batch):
+            batch_results = await run_in_threadpool(commit_bulk_batch, db, batch, seen_codes)
+            enrolled = [result["user_id"] for result in batch_results if result["status"] == STATUS_ENROLLED]
+            # Users created by another process are not in the directory yet
+            await run_in_threadpool(user_directory.fetch_missing, db, enrolled)
+            for user_id in enrolled:
+                user_directory.mark_enrolled(user_id)
+                share_user_change(user_id)
+            results.extend(batch_results)
+        
+        position = 0
+        while position < len(entries):
+            chunk = await run_in_threadpool(read_zip_images, archive, entries[position:position + chunk_size])
+            try:
+                encodings = await face_pool.map(
+                    extract_encoding_from_bytes, [(image_bytes,) for _, image_bytes in chunk],
+                    wait=BULK_ENROLL_WAIT_TIMEOUT
+                )
+            except FacePoolOverloaded:
+                break
+            position += len(chunk)
+            batch.extend(
+                (filename, image_bytes, encoding)
+                for (filename, image_bytes), encoding in zip(chunk, encodings)
+            )
+            if len(batch) >= BULK_ENROLL_BATCH_SIZE:
+                await commit(batch)
+                batch = []
+        
+        if batch:
+            await commit(batch)
+        if position < len(entries):
+            results.extend(not_processed_results(
+                [info.filename for info in entries[position:]], "Face workers busy, upload these files again"
+            ))
+    
+    return BulkEnrollResponse(
+        total=len(results),
+        summary=summarize_results(results),
+        results=[BulkEnrollResult(**result) for result in results]
+    )
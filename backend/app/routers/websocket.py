@@ -1,71 +1,290 @@
 """
 WebSocket router for real-time updates
 """
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from typing import Dict, List, Optional, Set
+import asyncio
+import hmac
 import json
 from datetime import datetime
 
-from app.database import Attendance, User
+from app.config import WS_SEND_QUEUE_SIZE, WS_SLOW_CLIENT_POLICY, WS_SEND_TIMEOUT, CAMERA_DEVICE_TOKEN
+from app.dependencies import get_current_user
+from app.services.backplane import backplane
+from app.services.camera_service import camera_streams
+from app.services.auth_service import verify_token
+from app.services.presence_service import presence
+from app.services.settings_service import settings_cache, SystemSettings
+from app.services.user_directory import user_directory
 
 router = APIRouter()
 
+class ClientConnection:
+    """A WebSocket client with its bounded send queue, drained by its own writer task"""
+    
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.cameras: Set[str] = set()  # Device ids whose camera stream the client watches
+        self.frames: Dict[str, bytes] = {}  # Latest unsent frame per device (latest wins)
+        self.wakeup = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+
+
 # Store active WebSocket connections
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """
+    Fan-out to WebSocket clients without waiting on any of them
+
+    A broadcast serializes the message once and only enqueues it for each
+    client; a writer task per client does the actual sends. When a slow
+    client's queue is full, the oldest queued message is dropped
+    ("drop_oldest") or the client is disconnected ("disconnect"), so one
+    client on a bad network never delays the others or the caller.
+    
+    Camera frames are binary messages sent only to clients subscribed to
+    the device, and never queued: each client holds at most one pending
+    frame per device, replaced by newer ones until the writer sends it.
+    """
+    
+    def __init__(
+        self,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        slow_client_policy: str = WS_SLOW_CLIENT_POLICY,
+        send_timeout: float = WS_SEND_TIMEOUT
+    ):
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        self.queue_size = queue_size
+        self.slow_client_policy = slow_client_policy
+        self.send_timeout = send_timeout
+        self.sent_messages = 0
+        self.dropped_messages = 0
+        self.slow_disconnects = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientConnection(websocket, self.queue_size)
+        client.writer = asyncio.create_task(self._write(client))
+        self.active_connections[websocket] = client
     
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client and client.writer is not asyncio.current_task():
+            client.writer.cancel()
     
-    async def broadcast_attendance(self, attendance_data: dict):
-        """Broadcast new attendance record to all connected clients"""
-        message = json.dumps({
-            "type": "attendance",
-            "data": attendance_data
-        })
+    def send(self, websocket: WebSocket, message: str):
+        """Queue an already serialized message for one client"""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
         
-        # Send to all connected clients
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error sending to client: {e}")
-                disconnected.append(connection)
-        
-        # Remove disconnected clients
-        for conn in disconnected:
-            self.disconnect(conn)
+        if client.queue.full():
+            if self.slow_client_policy == "disconnect":
+                print("Disconnecting slow WebSocket client (send queue full)")
+                self.slow_disconnects += 1
+                self.disconnect(websocket)
+                asyncio.create_task(self._close(websocket))
+                return
+            # Drop oldest: the client gets the latest messages once it catches up
+            client.queue.get_nowait()
+            client.dropped += 1
+            self.dropped_messages += 1
+        client.queue.put_nowait(message)
+        client.wakeup.set()
     
-    async def broadcast_camera_frame(self, frame_data: str):
-        """Broadcast camera frame to all connected clients"""
+    def broadcast(self, message_type: str, data):
+        """Serialize a message once, queue it for every client and relay it to other processes"""
         message = json.dumps({
-            "type": "camera_frame",
-            "data": frame_data
+            "type": message_type,
+            "data": data
         })
-        
-        # Send to all connected clients
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error sending frame to client: {e}")
-                disconnected.append(connection)
-        
-        # Remove disconnected clients
-        for conn in disconnected:
-            self.disconnect(conn)
+        self.fan_out(message)
+        backplane.publish(message)
+    
+    def notify_workers(self, message_type: str, data):
+        """Send an event to the other server processes only, never to clients (callable from any thread)"""
+        backplane.publish(json.dumps({
+            "type": message_type,
+            "data": data
+        }))
+    
+    def fan_out(self, message: str):
+        """Queue a serialized message for every client of this process"""
+        for websocket in list(self.active_connections):
+            self.send(websocket, message)
+    
+    async def broadcast_attendance(self, attendance_data: dict):
+        """Broadcast new attendance record to all connected clients"""
+        self.broadcast("attendance", attendance_data)
+    
+    async def broadcast_presence(self, presence_data: dict):
+        """Broadcast a user's first check-in of the day to all connected clients"""
+        self.broadcast("presence", presence_data)
+    
+    async def broadcast_settings(self, settings_data: dict):
+        """Broadcast updated system settings to all connected clients"""
+        self.broadcast("settings", settings_data)
+    
+    async def broadcast_attendance_batch(self, records: List[dict], presence_data: List[dict]):
+        """Broadcast a batch of new attendance records as a single message"""
+        self.broadcast("attendance_batch", {
+            "records": records,
+            "presence": presence_data
+        })
+    
+    def subscribe_camera(self, websocket: WebSocket, device_id: str, subscribe: bool = True):
+        """Start or stop streaming a device's camera to a client"""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        if subscribe:
+            client.cameras.add(device_id)
+        else:
+            client.cameras.discard(device_id)
+            client.frames.pop(device_id, None)
+    
+    def has_camera_subscribers(self, device_id: str) -> bool:
+        return any(device_id in client.cameras for client in self.active_connections.values())
+    
+    def publish_camera_frame(self, device_id: str, frame: bytes):
+        """Hand a packed binary frame to every subscribed client, replacing any unsent older one"""
+        for client in self.active_connections.values():
+            if device_id in client.cameras:
+                if device_id in client.frames:
+                    self.frames_skipped += 1
+                client.frames[device_id] = frame
+                client.wakeup.set()
+    
+    def metrics(self) -> dict:
+        """Queue depth and drop counters, for monitoring"""
+        depths = [client.queue.qsize() for client in self.active_connections.values()]
+        return {
+            "connections": len(depths),
+            "queue_size": self.queue_size,
+            "slow_client_policy": self.slow_client_policy,
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "sent_messages": self.sent_messages,
+            "dropped_messages": self.dropped_messages,
+            "slow_disconnects": self.slow_disconnects,
+            "camera_subscriptions": sum(len(client.cameras) for client in self.active_connections.values()),
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+            "frames_received": camera_streams.received,
+            "frames_rate_limited": camera_streams.rate_limited,
+            "backplane": backplane.name,
+            "backplane_published": getattr(backplane, "published", 0),
+            "backplane_received": getattr(backplane, "received", 0)
+        }
+    
+    async def _write(self, client: ClientConnection):
+        """Writer task: send queued messages to one client in order, then pending frames"""
+        try:
+            while True:
+                if not client.queue.empty():
+                    message = client.queue.get_nowait()
+                    await asyncio.wait_for(client.websocket.send_text(message), timeout=self.send_timeout)
+                    client.sent += 1
+                    self.sent_messages += 1
+                elif client.frames:
+                    _, frame = client.frames.popitem()
+                    await asyncio.wait_for(client.websocket.send_bytes(frame), timeout=self.send_timeout)
+                    self.frames_sent += 1
+                else:
+                    await client.wakeup.wait()
+                    client.wakeup.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending to client: {e}")
+            self.disconnect(client.websocket)
+            await self._close(client.websocket)
+    
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # Try again later
+        except Exception:
+            pass
+
 
 manager = ConnectionManager()
 
 
+async def _relay_remote_message(message: str):
+    """A broadcast from another server process: forward it to local clients, sync local state"""
+    try:
+        event = json.loads(message)
+        if event["type"] == "user":
+            # Worker-only event: user codes are not for WebSocket clients
+            _apply_user_change(event["data"])
+            return
+        if event["type"] == "settings":
+            # A relay overtaken by a newer update must not roll the settings back
+            settings = SystemSettings(**event["data"])
+            if settings_cache.set(settings) == settings:
+                manager.fan_out(message)
+            return
+        manager.fan_out(message)
+        
+        # Keep this process' presence tracker in step with check-ins made elsewhere
+        if event["type"] == "attendance":
+            records = [event["data"]]
+        elif event["type"] == "attendance_batch":
+            records = event["data"]["records"]
+        else:
+            return
+        for record in records:
+            if record["status"] == 'success' and record["user_id"]:
+                presence.check_in(record["user_id"], datetime.fromisoformat(record["timestamp"]))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Error handling backplane message: {e}")
+
+
+def _apply_user_change(data: dict):
+    """A user created, changed or deleted by another server process"""
+    user_id = data["id"]
+    if data.get("deleted"):
+        user_directory.remove(user_id)
+        presence.remove_user(user_id)
+    else:
+        user_directory.set(user_id, **data["entry"])
+
+
+def share_user_change(user_id: int):
+    """
+    Send a user's directory entry to the other server processes; skipped
+    when this process has no entry for it (they fetch it when needed)
+    """
+    entry = user_directory.get(user_id)
+    if entry is not None:
+        manager.notify_workers("user", {"id": user_id, "entry": entry._asdict()})
+
+
+def share_user_deletion(user_id: int):
+    """Tell the other server processes a user was deleted"""
+    manager.notify_workers("user", {"id": user_id, "deleted": True})
+
+
+async def start_backplane():
+    """Start relaying broadcasts between server processes"""
+    await backplane.start(_relay_remote_message)
+
+
+async def push_local_settings(settings: SystemSettings):
+    """Settings reloaded from the database: push them to this process' clients only"""
+    manager.fan_out(json.dumps({"type": "settings", "data": settings._asdict()}))
+
+
+async def stop_backplane():
+    await backplane.stop()
+
+
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """
@@ -75,20 +294,29 @@ async def websocket_endpoint(websocket: WebSocket):
     
     try:
         # Send initial subscription confirmation
-        await websocket.send_json({
+        manager.send(websocket, json.dumps({
             "type": "connected",
             "message": "Subscribed to attendance updates"
-        })
+        }))
+        # Current settings, so kiosks pick up changes made while disconnected
+        manager.send(websocket, json.dumps({
+            "type": "settings",
+            "data": settings_cache.get()._asdict()
+        }))
         
         # Keep connection alive and handle messages
         while True:
             data = await websocket.receive_text()
             
-            # Handle client messages (e.g., ping/pong)
+            # Handle client messages (e.g., ping/pong, camera stream selection)
             try:
                 message = json.loads(data)
                 if message.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
+                    manager.send(websocket, json.dumps({"type": "pong"}))
+                elif message.get("type") in ("subscribe_camera", "unsubscribe_camera"):
+                    manager.subscribe_camera(
+                        websocket, str(message["device_id"]), message["type"] == "subscribe_camera"
+                    )
             except:
                 pass
             
@@ -96,36 +324,77 @@ async def websocket_endpoint(websocket: WebSocket):
         manager.disconnect(websocket)
 
 
-# Function to broadcast new attendance (called from attendance router)
-async def broadcast_new_attendance(attendance_id: int, db: Session):
-    """Broadcast a new attendance record"""
-    from sqlalchemy.orm import Session as SessionType
-    from app.utils import GMT7
+def _camera_publisher_allowed(websocket: WebSocket) -> bool:
+    """Whether the connection carries the kiosk device token or a valid JWT"""
+    token = websocket.query_params.get("token")
+    if not token:
+        scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            return False
+    if CAMERA_DEVICE_TOKEN and hmac.compare_digest(token.encode(), CAMERA_DEVICE_TOKEN.encode()):
+        return True
+    payload = verify_token(token)
+    return payload is not None and payload.get("sub") is not None
+
+
+@router.websocket("/ws/camera/{device_id}")
+async def camera_publisher_endpoint(websocket: WebSocket, device_id: str):
+    """
+    WebSocket endpoint for a kiosk to publish its camera as binary JPEG
+    messages; frames are rate limited, downscaled for preview and relayed
+    only to clients subscribed to the device. Requires CAMERA_DEVICE_TOKEN
+    or a JWT (`?token=` or a Bearer header), checked before accepting.
+    """
+    if not _camera_publisher_allowed(websocket):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
     
-    attendance = db.query(Attendance).filter(Attendance.id == attendance_id).first()
-    if attendance:
-        user_name = None
-        if attendance.user_id:
-            user = db.query(User).filter(User.id == attendance.user_id).first()
-            if user:
-                user_name = user.name
-        
-        # Ensure timestamp is timezone-aware and serialize properly
-        timestamp = attendance.timestamp
-        if timestamp:
-            if timestamp.tzinfo is None:
-                timestamp = timestamp.replace(tzinfo=GMT7)
-            timestamp_str = timestamp.isoformat()
-        else:
-            timestamp_str = None
-        
-        attendance_data = {
-            "id": attendance.id,
-            "user_id": attendance.user_id,
-            "user_name": user_name,
-            "timestamp": timestamp_str,
-            "status": attendance.status,
-            "device_id": attendance.device_id
-        }
-        
-        await manager.broadcast_attendance(attendance_data)
+    try:
+        while True:
+            jpeg_bytes = await websocket.receive_bytes()
+            
+            # Skip all work for frames nobody watches or that exceed max FPS
+            if not manager.has_camera_subscribers(device_id) or not camera_streams.admit(device_id):
+                continue
+            try:
+                frame = await run_in_threadpool(camera_streams.preview, device_id, jpeg_bytes)
+            except Exception as e:
+                print(f"Error processing frame from {device_id}: {e}")
+                continue
+            manager.publish_camera_frame(device_id, frame)
+            
+    except WebSocketDisconnect:
+        camera_streams.forget(device_id)
+
+
+@router.get("/api/ws/metrics")
+def websocket_metrics(current_user: str = Depends(get_current_user)):
+    """WebSocket fan-out metrics: connections, queue depths, drops"""
+    return manager.metrics()
+
+
+# Functions to broadcast new attendance (called from attendance router)
+async def broadcast_attendance_record(attendance):
+    """Broadcast a new attendance record (AttendanceResponse) and update presence"""
+    await manager.broadcast_attendance(attendance.model_dump(mode="json"))
+    if attendance.status == 'success' and attendance.user_id:
+        await broadcast_check_in(attendance.user_id, attendance.timestamp)
+
+
+async def broadcast_check_in(user_id: int, timestamp: datetime):
+    """Update the presence tracker for a successful scan, announcing first check-ins"""
+    if presence.check_in(user_id, timestamp):
+        await manager.broadcast_presence(presence.delta(user_id))
+
+
+async def broadcast_scan_batch(attendances: list):
+    """Update presence for a batch of new attendance records and announce them in one message"""
+    presence_data = [
+        presence.delta(attendance.user_id)
+        for attendance in attendances
+        if attendance.status == 'success' and attendance.user_id
+        and presence.check_in(attendance.user_id, attendance.timestamp)
+    ]
+    records = [attendance.model_dump(mode="json") for attendance in attendances]
+    await manager.broadcast_attendance_batch(records, presence_data)
@@ -0,0 +1,296 @@
+"""
+Approximate nearest-neighbor index (IVF) for very large face galleries
+"""
+import copy
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+ENCODING_DIM = 128
+
+
+def kmeans(
+    vectors: np.ndarray,
+    n_clusters: int,
+    iterations: int = 15,
+    sample_size: Optional[int] = None,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    Lloyd's k-means on a random sample of the vectors
+
+    Args:
+        vectors: (N, D) float32 data
+        n_clusters: Number of centroids
+        iterations: Lloyd iterations
+        sample_size: Points used for training (default 64 per cluster)
+        seed: Random seed
+
+    Returns:
+        (n_clusters, D) float32 centroids
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or n_clusters * 64)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_clusters)
+
+        # Re-seed empty clusters with random sample points
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+
+    return centroids
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+    """Nearest centroid of every vector, in chunks to bound memory"""
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        assignments[start:start + chunk_size] = np.argmin(
+            centroid_norms[None, :] - 2.0 * (chunk @ centroids.T), axis=1
+        )
+    return assignments
+
+
+class _Additions:
+    """
+    Growable buffers of vectors added after training. Index objects derived
+    from one another share them: each reads only its own first `added`
+    entries and new entries are written past them, so an index handed to a
+    reader never changes underneath it.
+    """
+
+    def __init__(self, capacity: int = 0):
+        self.vectors = np.empty((capacity, ENCODING_DIM), dtype=np.float32)
+        self.norms = np.empty(capacity, dtype=np.float32)
+        self.lists = np.empty(capacity, dtype=np.int64)
+        self.rows = np.empty(capacity, dtype=np.int64)
+
+    def reserve(self, used: int, needed: int) -> "_Additions":
+        """Buffers able to hold `needed` entries (the first `used` kept)"""
+        if needed <= len(self.rows):
+            return self
+        grown = _Additions(max(64, len(self.rows) * 2, needed))
+        for name in ("vectors", "norms", "lists", "rows"):
+            getattr(grown, name)[:used] = getattr(self, name)[:used]
+        return grown
+
+
+class IVFIndex:
+    """
+    Inverted file index: a k-means coarse quantizer splits the gallery into
+    `nlist` lists, a query only scans the `nprobe` lists with the closest
+    centroids, and the best candidates are re-ranked with exact distances.
+
+    The vectors are stored permuted so that each list is one contiguous
+    block, which keeps scanning a list a single matrix product on a view
+    (at the cost of a second copy of the gallery matrix).
+
+    The index follows gallery changes without retraining: add() assigns new
+    rows to their nearest list (kept in a small side buffer), remap()
+    renumbers rows after a compaction, and searches skip excluded (deleted)
+    rows. `drift` tells how far it is from a fresh build, so re-clustering
+    can be left to an occasional background rebuild.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        vectors: np.ndarray,
+        row_ids: np.ndarray,
+        offsets: np.ndarray,
+        nprobe: int,
+        version: int = 0
+    ):
+        self.centroids = centroids
+        self.centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.vectors = vectors  # (N, D) permuted so each list is contiguous
+        self.vector_norms = np.einsum('ij,ij->i', vectors, vectors)
+        self.row_ids = row_ids  # (N,) original row of each permuted vector (-1 once removed)
+        self.offsets = offsets  # (nlist + 1,) list boundaries
+        self.nprobe = min(nprobe, len(centroids))
+        self.version = version  # Gallery layout version the row ids refer to
+        self._additions = _Additions()
+        self.added = 0  # Entries in the side buffer
+        self.removed = 0  # Entries whose row was deleted since training
+
+    def __len__(self) -> int:
+        return len(self.vectors) + self.added
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def drift(self) -> float:
+        """Share of entries added or removed since training"""
+        return (self.added + self.removed) / max(1, len(self.vectors))
+
+    @classmethod
+    def build(
+        cls,
+        encodings: np.ndarray,
+        nlist: int = 0,
+        nprobe: int = 8,
+        version: int = 0,
+        seed: int = 0,
+        row_ids: Optional[np.ndarray] = None
+    ) -> "IVFIndex":
+        """
+        Train the coarse quantizer and bucket every encoding
+
+        Args:
+            encodings: (N, 128) gallery matrix
+            nlist: Number of lists (0 = about 4 * sqrt(N))
+            nprobe: Lists scanned per query
+            version: Gallery layout version being indexed
+            seed: Random seed for k-means
+            row_ids: Optional (N,) gallery row of each encoding (default: its position)
+        """
+        started = time.perf_counter()
+        vectors = np.ascontiguousarray(encodings, dtype=np.float32)
+        nlist = nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = max(1, min(nlist, len(vectors)))
+
+        centroids = kmeans(vectors, nlist, seed=seed)
+        assignments = assign(vectors, centroids)
+
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=offsets[1:])
+
+        rows = order.astype(np.int64) if row_ids is None else np.asarray(row_ids, dtype=np.int64)[order]
+        index = cls(centroids, vectors[order], rows, offsets, nprobe, version)
+        print(f"IVF index built: {len(vectors)} vectors, {nlist} lists in {time.perf_counter() - started:.1f}s")
+        return index
+
+    def add(self, vectors: np.ndarray, row_ids: np.ndarray) -> "IVFIndex":
+        """Index with these rows added to their nearest lists (this one is left unchanged)"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        used, needed = self.added, self.added + len(vectors)
+        additions = self._additions.reserve(used, needed)
+        additions.vectors[used:needed] = vectors
+        additions.norms[used:needed] = np.einsum('ij,ij->i', vectors, vectors)
+        additions.lists[used:needed] = assign(vectors, self.centroids)
+        additions.rows[used:needed] = row_ids
+
+        index = copy.copy(self)
+        index._additions = additions
+        index.added = needed
+        return index
+
+    def discard(self, count: int) -> "IVFIndex":
+        """
+        Index noting that `count` of its rows were deleted (this one is left
+        unchanged); searches skip them through their `excluded` mask
+        """
+        index = copy.copy(self)
+        index.removed += count
+        return index
+
+    def remap(self, row_map: np.ndarray, version: int) -> "IVFIndex":
+        """
+        Index over renumbered gallery rows (this one is left unchanged)
+
+        Args:
+            row_map: (N,) new row of every old row, -1 for rows dropped
+            version: New gallery layout version
+        """
+        def mapped(rows):
+            return np.where(rows >= 0, row_map[np.maximum(rows, 0)], -1)
+
+        index = copy.copy(self)
+        index.row_ids = mapped(self.row_ids)
+        index._additions = _Additions(self.added)
+        for name in ("vectors", "norms", "lists"):
+            getattr(index._additions, name)[:] = getattr(self._additions, name)[:self.added]
+        index._additions.rows[:] = mapped(self._additions.rows[:self.added])
+        index.version = version
+        return index
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 1,
+        rerank: int = 32,
+        excluded: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate k nearest rows for each query
+
+        Args:
+            queries: (M, 128) encodings
+            k: Neighbors returned per query
+            rerank: Candidates re-scored with exact distances
+            excluded: Optional boolean mask over gallery rows never returned
+                (e.g. deleted templates)
+
+        Returns:
+            Tuple of ((M, k) gallery rows, (M, k) distances); -1 / inf when
+            fewer than k candidates were found
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        additions, added = self._additions, self.added
+
+        # Coarse quantizer: closest lists for every query at once
+        coarse = self.centroid_norms[None, :] - 2.0 * (queries @ self.centroids.T)
+        if self.nprobe < self.nlist:
+            probes = np.argpartition(coarse, self.nprobe - 1, axis=1)[:, :self.nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(self.nlist), (len(queries), self.nlist))
+
+        for q, query in enumerate(queries):
+            starts = self.offsets[probes[q]]
+            ends = self.offsets[probes[q] + 1]
+            # Scan each probed list in place (views, no gather copy); ||q||^2 is
+            # constant per query so it is left out of the ranking score
+            scores = np.concatenate([
+                self.vector_norms[start:end] - 2.0 * (self.vectors[start:end] @ query)
+                for start, end in zip(starts.tolist(), ends.tolist())
+            ])
+
+            # Map score positions back to vector positions without a Python loop
+            lengths = ends - starts
+            positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(len(scores))
+            candidate_rows = self.row_ids[positions]
+
+            # Entries added since training that fall in the probed lists
+            extra = np.flatnonzero(np.isin(additions.lists[:added], probes[q]))
+            if len(extra):
+                scores = np.concatenate((
+                    scores, additions.norms[extra] - 2.0 * (additions.vectors[extra] @ query)
+                ))
+                candidate_rows = np.concatenate((candidate_rows, additions.rows[extra]))
+
+            valid = candidate_rows >= 0
+            if excluded is not None:
+                valid &= ~excluded[np.maximum(candidate_rows, 0)]
+            valid = np.flatnonzero(valid)
+            if len(valid) == 0:
+                continue
+
+            # Exact re-ranking of the best candidates
+            top = min(max(k, rerank), len(valid))
+            candidates = valid[np.argpartition(scores[valid], top - 1)[:top]]
+            from_main = candidates < len(positions)
+            vectors = np.empty((len(candidates), ENCODING_DIM), dtype=np.float32)
+            vectors[from_main] = self.vectors[positions[candidates[from_main]]]
+            vectors[~from_main] = additions.vectors[extra[candidates[~from_main] - len(positions)]]
+            exact = np.linalg.norm(vectors - query, axis=1)
+            best = np.argsort(exact)[:k]
+            rows[q, :len(best)] = candidate_rows[candidates[best]]
+            distances[q, :len(best)] = exact[best]
+
+        return rows, distances
@@ -0,0 +1,229 @@
+"""
+Event backplane - relays WebSocket broadcasts between server processes
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from app.config import (
+    WS_BACKPLANE, WS_BACKPLANE_PATH, WS_BACKPLANE_POLL_MS, WS_BACKPLANE_RETENTION
+)
+
+MessageHandler = Callable[[str], Awaitable[None]]
+
+
+class InProcessBackplane:
+    """Single process: every client is local, nothing to relay"""
+
+    name = "memory"
+
+    async def start(self, on_message: MessageHandler):
+        pass
+
+    def publish(self, message: str):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class SQLiteBackplane(InProcessBackplane):
+    """
+    Multi-process relay on one host through a shared SQLite event log
+
+    Each process appends the messages it broadcasts to the log (in the
+    background, in batches) and tails the log for messages of the other
+    processes, handing them to on_message. Old events are pruned after
+    `retention` seconds. No service to run: workers only share the file.
+
+    Appending and tailing each run on their own thread with one connection
+    kept open for the lifetime of the backplane. Messages published before
+    start() are sent once it runs; after stop() they are appended to the
+    log directly.
+    """
+
+    name = "sqlite"
+
+    def __init__(
+        self,
+        path: Path = WS_BACKPLANE_PATH,
+        poll_interval_ms: int = WS_BACKPLANE_POLL_MS,
+        retention: float = WS_BACKPLANE_RETENTION
+    ):
+        self.path = Path(path)
+        self.poll_interval = poll_interval_ms / 1000
+        self.retention = retention
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._on_message: Optional[MessageHandler] = None
+        self._outbox: List[str] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []
+        self._last_id = 0
+        self._stopped = False
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self.published = 0
+        self.received = 0
+
+    async def start(self, on_message: MessageHandler):
+        self._on_message = on_message
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane-append")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane-tail")
+        self._last_id = await self._loop.run_in_executor(self._writer, self._setup)
+        self._stopped = False
+        self._tasks = [
+            asyncio.create_task(self._publish_loop()),
+            asyncio.create_task(self._tail_loop()),
+        ]
+        if self._outbox:
+            self._wakeup.set()
+        print(f"WebSocket backplane: SQLite event log {self.path} (origin {self.origin})")
+
+    def publish(self, message: str):
+        """Queue a broadcast for the other processes (never blocks while running, callable from any thread)"""
+        if self._loop is None:
+            # Not started yet: sent by the publish loop once it runs
+            self._outbox.append(message)
+        elif self._stopped:
+            self._append_now([message])
+        else:
+            self._loop.call_soon_threadsafe(self._enqueue, message)
+
+    def _enqueue(self, message: str):
+        # Event loop thread only, so the publish loop never races with appends
+        if self._stopped:
+            # Queued from another thread while stopping, after the final flush
+            self._append_now([message])
+            return
+        self._outbox.append(message)
+        self._wakeup.set()
+
+    async def stop(self):
+        if self._loop is None or self._stopped:
+            return
+        self._stopped = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._outbox:
+            batch, self._outbox = self._outbox, []
+            await self._loop.run_in_executor(self._writer, self._append_now, batch)
+        for executor in (self._writer, self._reader):
+            executor.shutdown(wait=True)
+        self._close_connections()
+
+    def _append_now(self, messages: List[str]):
+        """Append outside the publish loop, on a connection of its own"""
+        try:
+            with closing(self._open()) as conn:
+                self._append(messages, conn)
+            self.published += len(messages)
+        except Exception as e:
+            print(f"Error publishing {len(messages)} events to backplane: {e}")
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """The calling thread's connection to the log, opened on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _close_connections(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def _setup(self) -> int:
+        """Create the log if needed; start tailing after the current last event"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, "
+            "created REAL NOT NULL, message TEXT NOT NULL)"
+        )
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _append(self, messages: List[str], conn: Optional[sqlite3.Connection] = None):
+        now = time.time()
+        conn = conn or self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO events (origin, created, message) VALUES (?, ?, ?)",
+                [(self.origin, now, message) for message in messages]
+            )
+            conn.execute("DELETE FROM events WHERE created < ?", (now - self.retention,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _read(self, after_id: int) -> List[Tuple[int, str, str]]:
+        return self._connection().execute(
+            "SELECT id, origin, message FROM events WHERE id > ? ORDER BY id LIMIT 1000", (after_id,)
+        ).fetchall()
+
+    async def _publish_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            batch, self._outbox = self._outbox, []
+            if not batch:
+                continue
+            try:
+                await self._loop.run_in_executor(self._writer, self._append, batch)
+                self.published += len(batch)
+            except Exception as e:
+                print(f"Error publishing {len(batch)} events to backplane: {e}")
+
+    async def _tail_loop(self):
+        while True:
+            try:
+                rows = await self._loop.run_in_executor(self._reader, self._read, self._last_id)
+            except Exception as e:
+                print(f"Error reading backplane: {e}")
+                rows = []
+            for event_id, origin, message in rows:
+                self._last_id = event_id
+                if origin != self.origin:
+                    self.received += 1
+                    await self._on_message(message)
+            if len(rows) < 1000:
+                await asyncio.sleep(self.poll_interval)
+
+
+def create_backplane(kind: str = WS_BACKPLANE) -> InProcessBackplane:
+    """Backplane selected by WS_BACKPLANE"""
+    if kind == "sqlite":
+        return SQLiteBackplane()
+    if kind != "memory":
+        raise ValueError(f"Unknown WS_BACKPLANE {kind!r} (expected 'memory' or 'sqlite')")
+    return InProcessBackplane()
+
+
+# Process-wide backplane
+backplane = create_backplane()
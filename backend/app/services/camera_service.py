@@ -0,0 +1,90 @@
+"""
+Camera stream service - rate limiting, preview downscaling and binary framing
+"""
+import io
+import struct
+import time
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from app.config import CAMERA_MAX_FPS, CAMERA_PREVIEW_MAX_SIDE, CAMERA_PREVIEW_QUALITY
+
+# Binary WebSocket frame: u8 device id length, device id (UTF-8), JPEG bytes
+FRAME_HEADER = struct.Struct("<B")
+MAX_DEVICE_ID_BYTES = 255
+
+
+def pack_frame(device_id: str, jpeg_bytes: bytes) -> bytes:
+    """Binary WebSocket message carrying one camera frame"""
+    device = device_id.encode("utf-8")
+    if len(device) > MAX_DEVICE_ID_BYTES:
+        raise ValueError("Device id too long")
+    return FRAME_HEADER.pack(len(device)) + device + jpeg_bytes
+
+
+def unpack_frame(message: bytes) -> Tuple[str, bytes]:
+    """Inverse of pack_frame: (device id, JPEG bytes)"""
+    (length,) = FRAME_HEADER.unpack_from(message)
+    start = FRAME_HEADER.size
+    return message[start:start + length].decode("utf-8"), message[start + length:]
+
+
+def downscale_jpeg(jpeg_bytes: bytes, max_side: int, quality: int) -> bytes:
+    """Re-encode a JPEG frame so its longest side is at most max_side"""
+    image = Image.open(io.BytesIO(jpeg_bytes))
+    if max(image.size) <= max_side:
+        return jpeg_bytes
+
+    # Decode at reduced scale straight from the DCT coefficients when possible
+    image.draft("RGB", (max_side, max_side))
+    image = image.convert("RGB")
+    image.thumbnail((max_side, max_side))
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+class CameraStreams:
+    """
+    Per-device frame admission: frames arriving faster than max_fps are
+    dropped on ingest, before any decoding or fan-out work
+    """
+
+    def __init__(
+        self,
+        max_fps: float = CAMERA_MAX_FPS,
+        preview_max_side: int = CAMERA_PREVIEW_MAX_SIDE,
+        preview_quality: int = CAMERA_PREVIEW_QUALITY
+    ):
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.preview_max_side = preview_max_side
+        self.preview_quality = preview_quality
+        self._last_frame: Dict[str, float] = {}  # device_id -> monotonic time of last accepted frame
+        self.received = 0
+        self.rate_limited = 0
+
+    def admit(self, device_id: str, now: Optional[float] = None) -> bool:
+        """Whether a new frame from the device should be streamed"""
+        now = time.monotonic() if now is None else now
+        self.received += 1
+        if now - self._last_frame.get(device_id, float("-inf")) < self.min_interval:
+            self.rate_limited += 1
+            return False
+        self._last_frame[device_id] = now
+        return True
+
+    def preview(self, device_id: str, jpeg_bytes: bytes) -> bytes:
+        """Packed binary message with the (optionally downscaled) frame - CPU bound, run off the event loop"""
+        if self.preview_max_side:
+            jpeg_bytes = downscale_jpeg(jpeg_bytes, self.preview_max_side, self.preview_quality)
+        return pack_frame(device_id, jpeg_bytes)
+
+    def forget(self, device_id: str):
+        """Drop state of a device whose stream ended"""
+        self._last_frame.pop(device_id, None)
+
+
+# Process-wide camera streams
+camera_streams = CameraStreams()
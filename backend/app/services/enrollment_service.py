@@ -0,0 +1,236 @@
+"""
+Face enrollment service - single and bulk enrollment
+"""
+import os
+import threading
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session, selectinload
+
+from app.config import USER_IMAGES_DIR, MAX_FACE_TEMPLATES, BULK_ENROLL_MAX_FILES, BULK_ENROLL_MAX_BYTES
+from app.database import User, FaceTemplate, encode_encoding
+from app.services.gallery_service import gallery, user_image_url, record_gallery_change, CHANGE_UPSERT
+from app.utils import now_gmt7
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+# Bulk enrollment result statuses
+STATUS_ENROLLED = "enrolled"
+STATUS_NO_FACE = "no_face"
+STATUS_UNKNOWN_CODE = "unknown_code"
+STATUS_DUPLICATE = "duplicate"
+STATUS_NOT_PROCESSED = "not_processed"
+
+
+class GalleryUpdate(NamedTuple):
+    """Everything needed to finish a committed enrollment: image files and gallery"""
+    user_id: int
+    name: str
+    encodings: np.ndarray  # (K, 128) all templates of the user
+    image_url: Optional[str]
+    version: int
+    image_path: Path  # Final path of the new image
+    temp_path: Path  # Where the new image waits for the commit
+    old_image_path: Optional[Path]  # Previous image, deleted once committed
+
+
+def store_enrollment(
+    db: Session,
+    db_user: User,
+    image_bytes: bytes,
+    encoding: np.ndarray,
+    replace: bool = False
+) -> GalleryUpdate:
+    """
+    Add the encoding as a new face template of the user in the caller's
+    transaction, dropping the oldest templates beyond MAX_FACE_TEMPLATES
+    (or all previous ones if replace is set), and write the image to a
+    temporary file. Commit with commit_enrollments, then call
+    apply_to_gallery.
+    """
+    image_filename = f"user_{db_user.id}_{int(now_gmt7().timestamp())}.jpg"
+    image_path = USER_IMAGES_DIR / image_filename
+
+    # Old image is only deleted once the new one is committed
+    old_image_path = None
+    if db_user.image_path:
+        old_filename = Path(db_user.image_path).name
+        if old_filename != image_filename:
+            old_image_path = USER_IMAGES_DIR / old_filename
+
+    # Add template, oldest ones beyond the cap are deleted (delete-orphan)
+    templates = db_user.templates
+    if replace:
+        templates.clear()
+    templates.append(FaceTemplate(encoding_blob=encode_encoding(encoding)))
+    while len(templates) > MAX_FACE_TEMPLATES:
+        templates.pop(0)
+
+    # Latest encoding stays on the user as its primary encoding
+    db_user.set_encoding(encoding)
+    db_user.image_path = image_filename  # Store filename only
+    db_user.updated_at = now_gmt7()
+    version = record_gallery_change(db, db_user.id, CHANGE_UPSERT)
+
+    # Written last, so nothing is left behind if the database work fails
+    temp_path = image_path.with_name(f"{image_filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(image_bytes)
+
+    return GalleryUpdate(
+        user_id=db_user.id,
+        name=db_user.name,
+        encodings=np.stack([template.get_encoding() for template in templates]),
+        image_url=user_image_url(db_user.id, image_filename),
+        version=version,
+        image_path=image_path,
+        temp_path=temp_path,
+        old_image_path=old_image_path
+    )
+
+
+def commit_enrollments(db: Session, updates: List[GalleryUpdate]):
+    """
+    Commit the caller's transaction, then move the new images into place
+    and delete the ones they replace. If the commit fails the new images
+    are deleted instead, so image files always match the committed rows.
+    """
+    try:
+        db.commit()
+    except Exception:
+        for update in updates:
+            update.temp_path.unlink(missing_ok=True)
+        raise
+
+    for update in updates:
+        os.replace(update.temp_path, update.image_path)
+        if update.old_image_path is not None:
+            update.old_image_path.unlink(missing_ok=True)
+
+
+def apply_to_gallery(update: GalleryUpdate):
+    """Mirror a committed enrollment into the in-memory gallery"""
+    gallery.upsert(update.user_id, update.name, update.encodings, update.image_url, update.version)
+
+
+def user_code_from_filename(filename: str) -> str:
+    """Files are keyed by user code: '<code>.jpg'"""
+    return Path(filename).stem.strip()
+
+
+def is_image_file(filename: str) -> bool:
+    """Image files only, skipping hidden files and macOS resource forks"""
+    path = Path(filename)
+    return (
+        path.suffix.lower() in IMAGE_EXTENSIONS
+        and not path.name.startswith(".")
+        and "__MACOSX" not in path.parts
+    )
+
+
+def zip_image_entries(
+    archive: zipfile.ZipFile,
+    max_files: int = BULK_ENROLL_MAX_FILES,
+    max_bytes: int = BULK_ENROLL_MAX_BYTES
+) -> List[zipfile.ZipInfo]:
+    """
+    Image entries of a ZIP archive, checked against the upload limits
+    (reading an entry never yields more than its declared size)
+
+    Raises:
+        ValueError: Too many images or too many uncompressed bytes
+    """
+    entries = [info for info in archive.infolist() if not info.is_dir() and is_image_file(info.filename)]
+    if len(entries) > max_files:
+        raise ValueError(f"ZIP archive holds {len(entries)} images, at most {max_files} are accepted")
+    total = sum(info.file_size for info in entries)
+    if total > max_bytes:
+        raise ValueError(f"ZIP archive images total {total} bytes uncompressed, at most {max_bytes} are accepted")
+    return entries
+
+
+def read_zip_images(archive: zipfile.ZipFile, entries: Iterable[zipfile.ZipInfo]) -> List[Tuple[str, bytes]]:
+    """(filename, bytes) of ZIP entries - blocking, run off the event loop"""
+    return [(info.filename, archive.read(info)) for info in entries]
+
+
+def iter_directory_images(directory: Path) -> Iterator[Tuple[str, bytes]]:
+    """Yield (filename, bytes) for every image in a directory tree, lazily"""
+    for path in sorted(directory.rglob("*")):
+        if path.is_file() and is_image_file(str(path.relative_to(directory))):
+            yield str(path.relative_to(directory)), path.read_bytes()
+
+
+def commit_bulk_batch(
+    db: Session,
+    batch: List[Tuple[str, bytes, Optional[np.ndarray]]],
+    seen_codes: set
+) -> List[Dict]:
+    """
+    Write one batch of encoded images in a single transaction
+
+    Args:
+        db: Database session
+        batch: (filename, image bytes, encoding or None if no face) tuples
+        seen_codes: Codes already enrolled in this run (updated in place)
+
+    Returns:
+        Per-file result dicts
+    """
+    codes = {user_code_from_filename(filename) for filename, _, _ in batch}
+    users = {
+        user.code: user for user in
+        db.query(User).options(selectinload(User.templates)).filter(User.code.in_(codes)).all()
+    }
+
+    results = []
+    enrolled = []
+    for filename, image_bytes, encoding in batch:
+        code = user_code_from_filename(filename)
+        result = {"file": filename, "code": code, "user_id": None, "status": STATUS_ENROLLED, "detail": None}
+        results.append(result)
+
+        db_user = users.get(code)
+        if db_user is None:
+            result["status"] = STATUS_UNKNOWN_CODE
+            result["detail"] = "No user with this code"
+            continue
+        result["user_id"] = db_user.id
+        if code in seen_codes:
+            result["status"] = STATUS_DUPLICATE
+            result["detail"] = "Another image for this code was already enrolled"
+            continue
+        if encoding is None:
+            result["status"] = STATUS_NO_FACE
+            result["detail"] = "No face detected"
+            continue
+
+        seen_codes.add(code)
+        enrolled.append(store_enrollment(db, db_user, image_bytes, encoding))
+
+    commit_enrollments(db, enrolled)
+
+    for update in enrolled:
+        apply_to_gallery(update)
+
+    return results
+
+
+def not_processed_results(filenames: Iterable[str], detail: str) -> List[Dict]:
+    """Results for files left out of a bulk enrollment"""
+    return [
+        {"file": filename, "code": user_code_from_filename(filename), "user_id": None,
+         "status": STATUS_NOT_PROCESSED, "detail": detail}
+        for filename in filenames
+    ]
+
+
+def summarize_results(results: Iterable[Dict]) -> Dict[str, int]:
+    """Count results per status"""
+    summary: Dict[str, int] = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return summary
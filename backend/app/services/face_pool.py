@@ -0,0 +1,128 @@
+"""
+Process pool for CPU-bound face recognition work
+"""
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional
+
+from app.config import FACE_WORKERS, FACE_QUEUE_LIMIT
+
+
+class FacePoolOverloaded(Exception):
+    """Raised when the face pool already has too many jobs queued"""
+
+
+def _init_worker():
+    """Import face_recognition and warm the dlib models once per worker process"""
+    import numpy as np
+    import face_recognition
+    
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_locations(blank, model='hog')
+    face_recognition.face_encodings(blank, [(8, 56, 56, 8)], model='large')
+
+
+def create_face_executor(workers: int = FACE_WORKERS) -> ProcessPoolExecutor:
+    """Process pool whose workers have face_recognition loaded and warm"""
+    # spawn: workers must not inherit the event loop, DB connections or threads
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker
+    )
+
+
+class FacePool:
+    """
+    Bounded, async-friendly front end to a process pool running the
+    functions of face_service, so HOG/CNN runs neither block the event
+    loop nor contend for the GIL with request handling.
+    """
+    
+    def __init__(self, workers: int = FACE_WORKERS, queue_limit: int = FACE_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0  # Only touched from the event loop thread
+        self._released: Optional[asyncio.Event] = None  # Set whenever a job ends, for callers waiting for room
+    
+    @property
+    def pending(self) -> int:
+        return self._pending
+    
+    def start(self):
+        """Start worker processes (they warm up in the background)"""
+        if self._executor is None:
+            self._executor = create_face_executor(self.workers)
+            print(f"Face pool started with {self.workers} workers (queue limit {self.queue_limit})")
+    
+    def shutdown(self):
+        """Stop worker processes, cancelling queued jobs"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    async def run(self, fn: Callable, *args) -> Any:
+        """Run fn(*args) in a worker process"""
+        return (await self.map(fn, [args]))[0]
+    
+    def has_room(self, jobs: int) -> bool:
+        """Whether a batch of this many jobs would be admitted now"""
+        return self._pending == 0 or self._pending + jobs <= self.queue_limit
+    
+    async def map(self, fn: Callable, args_list: Iterable[tuple], wait: float = 0) -> List[Any]:
+        """
+        Run fn for every argument tuple in parallel across workers.
+        The whole batch is admitted or rejected at once; an idle pool
+        always admits one batch, whatever its size. With `wait`, a full
+        pool is waited on for up to that many seconds before rejecting.
+        """
+        args_list = list(args_list)
+        if not self.has_room(len(args_list)):
+            await self._wait_for_room(len(args_list), wait)
+        
+        self.start()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for args in args_list:
+            job = self._executor.submit(fn, *args)
+            # Counted until the job itself ends (or is cancelled before starting):
+            # a request that gives up does not stop jobs already running
+            self._pending += 1
+            job.add_done_callback(functools.partial(self._job_done, loop))
+            futures.append(asyncio.wrap_future(job, loop=loop))
+        return await asyncio.gather(*futures)
+    
+    def _job_done(self, loop: asyncio.AbstractEventLoop, job: Future):
+        """Executor callback (any thread): release the job's slot on the event loop"""
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # Loop already closed at shutdown
+    
+    def _release(self):
+        self._pending -= 1
+        if self._released is not None:
+            self._released.set()
+    
+    async def _wait_for_room(self, jobs: int, timeout: float):
+        """Wait until the pool would admit `jobs` more jobs, FacePoolOverloaded after timeout"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        if self._released is None:
+            self._released = asyncio.Event()
+        while not self.has_room(jobs):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise FacePoolOverloaded()
+            self._released.clear()
+            try:
+                await asyncio.wait_for(self._released.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise FacePoolOverloaded()
+
+
+# Process-wide face pool
+face_pool = FacePool()
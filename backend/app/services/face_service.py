@@ -1,10 +1,15 @@
 """
 Face recognition service utilities
 """
+import time
 import face_recognition
 import numpy as np
-from typing import Optional, List, Tuple
-from app.config import FACE_RECOGNITION_THRESHOLD
+from typing import Any, Dict, Optional, List, Tuple, Union
+from app.config import (
+    FACE_RECOGNITION_THRESHOLD, FACE_DETECTION_PROFILE,
+    FACE_DETECTION_MAX_SIDE, FACE_ENCODING_MAX_SIDE
+)
+from app.services.gallery_matrix import matrix_blocks
 
 
 def extract_encoding_from_image(image_path: str) -> Optional[np.ndarray]:
@@ -32,56 +37,238 @@ def extract_encoding_from_image(image_path: str) -> Optional[np.ndarray]:
         return None
 
 
-def extract_encoding_from_bytes(image_bytes: bytes) -> Optional[np.ndarray]:
+# Landmark model of every encoding, whatever the profile: 5-point ('small')
+# and 68-point ('large') encodings must never be mixed in one gallery
+LANDMARK_MODEL = "large"
+
+# Detection cascade speed profiles
+#   num_jitters:    re-samples per encoding (higher = slower, slightly more accurate)
+#   upsample:       HOG upsampling levels tried in order on the downscaled image
+#   allow_cnn:      fall back to the (slow on CPU) CNN detector if HOG finds nothing
+DETECTION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "fast": {"num_jitters": 1, "upsample": (0, 1), "allow_cnn": False},
+    "balanced": {"num_jitters": 1, "upsample": (1, 2), "allow_cnn": False},
+    "accurate": {"num_jitters": 2, "upsample": (1, 2), "allow_cnn": True},
+}
+
+
+def get_detection_profile(name: str) -> Dict[str, Any]:
+    """Detection profile by name"""
+    if name not in DETECTION_PROFILES:
+        raise ValueError(
+            f"Unknown detection profile {name!r} (expected one of {', '.join(DETECTION_PROFILES)})"
+        )
+    return DETECTION_PROFILES[name]
+
+
+# Profile selected by FACE_DETECTION_PROFILE, checked at import
+DEFAULT_PROFILE = get_detection_profile(FACE_DETECTION_PROFILE)
+
+FaceLocation = Tuple[int, int, int, int]  # top, right, bottom, left
+
+
+def load_image(image_bytes: bytes, max_side: int = FACE_ENCODING_MAX_SIDE):
     """
-    Extract face encoding from image bytes
+    Decode image bytes to an RGB PIL image no larger than max_side
+    
+    JPEGs are decoded in draft mode, letting libjpeg decode directly at a
+    reduced scale (1/2, 1/4, 1/8) instead of decoding every pixel of a
+    12 MP photo and throwing most of them away.
     
     Args:
         image_bytes: Image file bytes
+        max_side: Maximum length of the longest side (0 = full resolution)
         
     Returns:
-        numpy array of 128-dim encoding or None if no face found
+        RGB PIL image
     """
-    try:
-        import io
-        from PIL import Image
+    import io
+    from PIL import Image, ImageOps
+    
+    # Convert bytes to PIL Image
+    image = Image.open(io.BytesIO(image_bytes))
+    if max_side and image.format == 'JPEG':
+        image.draft('RGB', (max_side, max_side))
+    
+    # Respect camera orientation so faces are upright for HOG
+    image = ImageOps.exif_transpose(image)
+    
+    # Convert to RGB if needed
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BILINEAR)
+    
+    return image
+
+
+def load_image_array(image_bytes: bytes) -> np.ndarray:
+    """
+    Decode image bytes to a full resolution RGB numpy array
+    
+    Args:
+        image_bytes: Image file bytes
         
-        # Convert bytes to PIL Image
-        image = Image.open(io.BytesIO(image_bytes))
+    Returns:
+        (H, W, 3) uint8 array
+    """
+    return np.array(load_image(image_bytes, max_side=0))
+
+
+def detect_face_locations(
+    image,
+    profile: Dict[str, Any],
+    timings: Optional[Dict[str, float]] = None,
+    detection_max_side: int = FACE_DETECTION_MAX_SIDE
+) -> List[FaceLocation]:
+    """
+    Run the detection cascade on a downscaled copy of the image
+    
+    Args:
+        image: RGB PIL image
+        profile: One of DETECTION_PROFILES
+        timings: Optional dict receiving per-stage durations in ms
+        detection_max_side: Longest side of the copy used for detection
         
-        # Convert to RGB if needed
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+    Returns:
+        Face locations mapped back to the coordinates of `image`
+    """
+    from PIL import Image
+    
+    timings = timings if timings is not None else {}
+    
+    started = time.perf_counter()
+    width, height = image.size
+    scale = min(1.0, detection_max_side / max(width, height))
+    if scale < 1.0:
+        small = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    else:
+        small = image
+    small_array = np.asarray(small)
+    timings["downscale"] = (time.perf_counter() - started) * 1000
+    
+    # HOG, upsampling more only if nothing is found
+    face_locations = []
+    started = time.perf_counter()
+    for upsample in profile["upsample"]:
+        face_locations = face_recognition.face_locations(small_array, number_of_times_to_upsample=upsample, model='hog')
+        if len(face_locations) > 0:
+            break
+    timings["detect_hog"] = (time.perf_counter() - started) * 1000
+    
+    # If still no face, try with CNN model (more accurate but slower)
+    if len(face_locations) == 0 and profile["allow_cnn"]:
+        started = time.perf_counter()
+        face_locations = face_recognition.face_locations(small_array, model='cnn')
+        timings["detect_cnn"] = (time.perf_counter() - started) * 1000
+    
+    # Map boxes back to the full resolution image
+    return [
+        (
+            max(0, int(top / scale)),
+            min(width, int(right / scale)),
+            min(height, int(bottom / scale)),
+            max(0, int(left / scale))
+        )
+        for top, right, bottom, left in face_locations
+    ]
+
+
+def encode_faces_from_bytes(image_bytes: bytes) -> Tuple[List[FaceLocation], np.ndarray]:
+    """
+    Detect every face in an image and encode them all in one pass
+    
+    Args:
+        image_bytes: Image file bytes
         
-        # Convert to numpy array
-        image_array = np.array(image)
+    Returns:
+        Tuple of (face locations as (top, right, bottom, left), (K, 128) float32 encodings)
+    """
+    empty = ([], np.empty((0, 128), dtype=np.float32))
+    try:
+        profile = DEFAULT_PROFILE
+        image = load_image(image_bytes, max_side=0)
         
-        # Try to find face with different settings
-        # Use consistent model (large) for better accuracy and consistency with recognition
-        # First try with default settings but use large model
-        encodings = face_recognition.face_encodings(image_array, num_jitters=1, model='large')
+        # Detect once, then encode all locations with a single call
+        face_locations = detect_face_locations(image, profile)
+        if len(face_locations) == 0:
+            return empty
+        
+        encodings = face_recognition.face_encodings(
+            np.asarray(image), face_locations,
+            num_jitters=profile["num_jitters"], model=LANDMARK_MODEL
+        )
+        return (
+            face_locations,
+            np.asarray(encodings, dtype=np.float32).reshape(-1, 128)
+        )
+    except Exception as e:
+        print(f"Error encoding faces from bytes: {e}")
+        return empty
+
+
+def extract_encoding_with_timings(
+    image_bytes: bytes,
+    profile_name: Optional[str] = None
+) -> Tuple[Optional[np.ndarray], Dict[str, float]]:
+    """
+    Extract the encoding of the largest face, reporting per-stage timings
+    
+    Pipeline: reduced-scale decode -> detection on a downscaled copy ->
+    boxes mapped back -> encoding on the decoded image.
+    
+    Args:
+        image_bytes: Image file bytes
+        profile_name: 'fast', 'balanced' or 'accurate' (default: FACE_DETECTION_PROFILE)
         
-        # If no face found, try with upsampling (helps with smaller faces)
-        if len(encodings) == 0:
-            # Try to detect face locations first with upsampling
-            face_locations = face_recognition.face_locations(image_array, model='hog', number_of_times_to_upsample=2)
-            if len(face_locations) > 0:
-                encodings = face_recognition.face_encodings(image_array, face_locations, num_jitters=1, model='large')
+    Returns:
+        Tuple of (128-dim encoding or None if no face found, stage -> milliseconds)
+    """
+    profile = get_detection_profile(profile_name) if profile_name else DEFAULT_PROFILE
+    timings: Dict[str, float] = {}
+    total_started = time.perf_counter()
+    encoding = None
+    
+    try:
+        started = time.perf_counter()
+        image = load_image(image_bytes)
+        timings["decode"] = (time.perf_counter() - started) * 1000
         
-        # If still no face, try with CNN model (more accurate but slower)
-        if len(encodings) == 0:
-            face_locations = face_recognition.face_locations(image_array, model='cnn')
-            if len(face_locations) > 0:
-                encodings = face_recognition.face_encodings(image_array, face_locations, num_jitters=1, model='large')
+        face_locations = detect_face_locations(image, profile, timings)
         
-        if len(encodings) > 0:
-            return encodings[0]  # Return first face found
-        return None
+        if len(face_locations) > 0:
+            # Enrollment photos: keep the largest face
+            largest = max(face_locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]))
+            started = time.perf_counter()
+            encodings = face_recognition.face_encodings(
+                np.asarray(image), [largest],
+                num_jitters=profile["num_jitters"], model=LANDMARK_MODEL
+            )
+            timings["encode"] = (time.perf_counter() - started) * 1000
+            if len(encodings) > 0:
+                encoding = encodings[0]
     except Exception as e:
         print(f"Error extracting encoding from bytes: {e}")
         import traceback
         traceback.print_exc()
-        return None
+    
+    timings["total"] = (time.perf_counter() - total_started) * 1000
+    return encoding, timings
+
+
+def extract_encoding_from_bytes(image_bytes: bytes) -> Optional[np.ndarray]:
+    """
+    Extract face encoding from image bytes
+    
+    Args:
+        image_bytes: Image file bytes
+        
+    Returns:
+        numpy array of 128-dim encoding or None if no face found
+    """
+    encoding, _ = extract_encoding_with_timings(image_bytes)
+    return encoding
 
 
 def compare_encodings(encoding1: np.ndarray, encoding2: np.ndarray) -> float:
@@ -100,7 +287,7 @@ def compare_encodings(encoding1: np.ndarray, encoding2: np.ndarray) -> float:
 
 def find_best_match(
     target_encoding: np.ndarray,
-    known_encodings: List[np.ndarray],
+    known_encodings: Union[np.ndarray, List[np.ndarray]],
     threshold: float = FACE_RECOGNITION_THRESHOLD
 ) -> Optional[Tuple[int, float]]:
     """
@@ -108,7 +295,7 @@ def find_best_match(
     
     Args:
         target_encoding: Encoding to match
-        known_encodings: List of known encodings
+        known_encodings: (N, 128) matrix (e.g. a gallery snapshot) or list of known encodings
         threshold: Maximum distance for a match
         
     Returns:
@@ -117,7 +304,9 @@ def find_best_match(
     if len(known_encodings) == 0:
         return None
     
-    # Calculate distances
+    # Calculate distances (a single vectorized pass over the whole matrix)
+    if not isinstance(known_encodings, np.ndarray):
+        known_encodings = np.asarray(known_encodings, dtype=np.float32)
     distances = face_recognition.face_distance(known_encodings, target_encoding)
     
     # Find best match
@@ -129,3 +318,139 @@ def find_best_match(
         return (int(best_match_index), float(best_distance))
     
     return None
+
+
+def match_encodings(
+    query_encodings: np.ndarray,
+    known_encodings: np.ndarray,
+    threshold: float = FACE_RECOGNITION_THRESHOLD
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Match many encodings against a gallery with one matrix operation
+    
+    The whole (M, N) distance matrix comes from a single matrix product.
+    
+    Args:
+        query_encodings: (M, 128) encodings to identify
+        known_encodings: (N, 128) gallery matrix
+        threshold: Maximum distance for a match
+        
+    Returns:
+        Tuple of (best index per query, best distance per query, matched mask)
+    """
+    queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, 128)
+    known = np.asarray(known_encodings, dtype=np.float32).reshape(-1, 128)
+    
+    if len(queries) == 0 or len(known) == 0:
+        count = len(queries)
+        return (
+            np.full(count, -1, dtype=np.int64),
+            np.full(count, np.inf, dtype=np.float32),
+            np.zeros(count, dtype=bool)
+        )
+    
+    squared = _squared_distances(queries, known)
+    best_indexes = np.argmin(squared, axis=1)
+    best_squared = squared[np.arange(len(queries)), best_indexes]
+    best_distances = np.sqrt(np.maximum(best_squared, 0.0))
+    
+    return best_indexes, best_distances, best_distances < threshold
+
+
+def match_encodings_per_user(
+    query_encodings: np.ndarray,
+    known_encodings: np.ndarray,
+    segment_starts: np.ndarray,
+    threshold: float = FACE_RECOGNITION_THRESHOLD,
+    excluded_segments: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Match many encodings against a gallery holding several templates per user
+    
+    Distances to every template come from one matrix product (one per block
+    of a GalleryMatrix), then np.minimum.reduceat reduces each user's
+    contiguous block of templates to its minimum - linear in the total
+    number of templates, with no Python loop per user.
+    
+    Args:
+        query_encodings: (M, 128) encodings to identify
+        known_encodings: (N, 128) templates (array or GalleryMatrix), grouped contiguously per user
+        segment_starts: (U,) first template row of each user
+        threshold: Maximum distance for a match
+        excluded_segments: Optional (U,) mask of segments never matched
+            (e.g. rows of deleted templates)
+        
+    Returns:
+        Tuple of (best user segment per query, best distance per query,
+        matched mask, (M, U) per-user minimum distances)
+    """
+    queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, 128)
+    blocks = [np.asarray(block, dtype=np.float32).reshape(-1, 128) for block in matrix_blocks(known_encodings)]
+    
+    if len(queries) == 0 or sum(len(block) for block in blocks) == 0:
+        count = len(queries)
+        return (
+            np.full(count, -1, dtype=np.int64),
+            np.full(count, np.inf, dtype=np.float32),
+            np.zeros(count, dtype=bool),
+            np.empty((count, len(segment_starts)), dtype=np.float32)
+        )
+    
+    if len(blocks) == 1:
+        squared = _squared_distances(queries, blocks[0])
+    else:
+        squared = np.hstack([_squared_distances(queries, block) for block in blocks])
+    per_user_squared = np.minimum.reduceat(squared, segment_starts, axis=1)
+    per_user = np.sqrt(np.maximum(per_user_squared, 0.0))
+    if excluded_segments is not None:
+        per_user[:, excluded_segments] = np.inf
+    best_segments = np.argmin(per_user, axis=1)
+    best_distances = per_user[np.arange(len(queries)), best_segments]
+    
+    return best_segments, best_distances, best_distances < threshold, per_user
+
+
+def identify_in_gallery(
+    query_encodings: np.ndarray,
+    snapshot,
+    threshold: float = FACE_RECOGNITION_THRESHOLD,
+    ann_index=None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Closest gallery row for each encoding, using the approximate index when
+    one is available for this snapshot and the exact per-user scan otherwise
+    
+    Args:
+        query_encodings: (M, 128) encodings to identify
+        snapshot: GallerySnapshot to search
+        threshold: Maximum distance for a match
+        ann_index: Optional IVFIndex built from the snapshot rows
+        
+    Returns:
+        Tuple of (best gallery row per query, best distance per query, matched mask)
+    """
+    # Blocks of replaced or deleted templates have a negative owner id
+    if ann_index is not None:
+        rows, distances = ann_index.search(query_encodings, k=1, excluded=snapshot.user_ids < 0)
+        rows, distances = rows[:, 0], distances[:, 0]
+        alive = (rows >= 0) & (snapshot.user_ids[np.maximum(rows, 0)] >= 0)
+        return rows, distances, alive & (distances < threshold)
+    
+    best_segments, best_distances, matched, _ = match_encodings_per_user(
+        query_encodings, snapshot.encodings, snapshot.segment_starts, threshold,
+        excluded_segments=snapshot.user_ids[snapshot.segment_starts] < 0
+    )
+    rows = snapshot.segment_starts[best_segments] if len(snapshot.segment_starts) else best_segments
+    return rows, best_distances, matched
+
+
+def _squared_distances(queries: np.ndarray, known: np.ndarray) -> np.ndarray:
+    """
+    (M, N) squared euclidean distances from a single matrix product,
+    using ||q - k||^2 = ||q||^2 + ||k||^2 - 2 q.k
+    """
+    return (
+        np.einsum('ij,ij->i', queries, queries)[:, None]
+        + np.einsum('ij,ij->i', known, known)[None, :]
+        - 2.0 * (queries @ known.T)
+    )
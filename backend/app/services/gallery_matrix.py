@@ -0,0 +1,57 @@
+"""
+Gallery matrix - read-only template matrix stored as consecutive blocks
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+
+ENCODING_DIM = 128
+
+
+class GalleryMatrix:
+    """
+    (N, 128) float32 matrix made of consecutive row blocks, typically the
+    memory-mapped published gallery followed by a small private block of
+    rows appended since. Rows can be added without copying the shared
+    block; code that needs every row scans `blocks` one after the other.
+
+    Supports len(), `shape`, row indexing with an int array or a slice
+    (returning a gathered ndarray) and np.asarray (which copies).
+    """
+
+    def __init__(self, blocks: Sequence[np.ndarray]):
+        self.blocks = tuple(block for block in blocks if len(block))
+        self.starts = np.cumsum([0] + [len(block) for block in self.blocks])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    @property
+    def shape(self):
+        return (len(self), ENCODING_DIM)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        out = np.empty((len(rows), ENCODING_DIM), dtype=np.float32)
+        for block, start in zip(self.blocks, self.starts.tolist()):
+            inside = (rows >= start) & (rows < start + len(block))
+            out[inside] = block[rows[inside] - start]
+        return out
+
+    def __array__(self, dtype: Optional[np.dtype] = None, copy: Optional[bool] = None) -> np.ndarray:
+        if not self.blocks:
+            matrix = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        else:
+            matrix = np.concatenate(self.blocks)
+        return matrix if dtype is None else matrix.astype(dtype, copy=False)
+
+
+def matrix_blocks(matrix) -> Sequence[np.ndarray]:
+    """Row blocks of a GalleryMatrix, or the array itself as one block"""
+    return matrix.blocks if isinstance(matrix, GalleryMatrix) else (matrix,)
@@ -0,0 +1,891 @@
+"""
+In-memory face gallery index shared by the whole process
+"""
+import gzip
+import json
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks
+    fcntl = None
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.config import (
+    FACE_INDEX_TYPE, FACE_IVF_NLIST, FACE_IVF_NPROBE, FACE_IVF_MIN_SIZE, FACE_IVF_REBUILD_DELAY,
+    GALLERY_SNAPSHOT_PATH, GALLERY_SNAPSHOT_DELAY, GALLERY_SNAPSHOT_MIN_INTERVAL
+)
+from app.database import SessionLocal, User, FaceTemplate, GalleryChange, decode_encoding, ENCODING_DTYPE
+from app.services.ann_index import IVFIndex
+from app.services.gallery_matrix import GalleryMatrix
+
+ENCODING_DIM = 128
+ENCODING_BYTES = ENCODING_DIM * ENCODING_DTYPE.itemsize
+
+# Gallery change log operations
+CHANGE_UPSERT = "upsert"
+CHANGE_DELETE = "delete"
+
+# Owner id of rows whose templates were replaced or deleted, until compaction
+TOMBSTONE = -1
+
+# Share of IVF entries added or removed since training that triggers re-clustering
+IVF_MAX_DRIFT = 0.25
+
+# Binary wire format (all little-endian):
+#   fixed header  magic "FGAL", format version u16, flags u16 (bit 0 = full),
+#                 gallery version u64, row count u32, dim u32, index length u32
+#   index         UTF-8 JSON {"user_ids", "names", "image_paths", "deleted"}
+#   padding       zero bytes up to a 16-byte boundary
+#   matrix        row count x dim float32, ready for a single np.frombuffer
+# There is one row per face template (format version 2): the rows of a user
+# are contiguous, oldest template first, and in a delta they replace every
+# row the client holds for that user id.
+# A full gallery in this format is also the snapshot file shared by server
+# processes, which memory-map its matrix instead of holding their own copy.
+GALLERY_MEDIA_TYPE = "application/x-face-gallery"
+WIRE_FORMAT_VERSION = 2
+_WIRE_MAGIC = b"FGAL"
+_WIRE_HEADER = struct.Struct("<4sHHQIII")
+_WIRE_ALIGN = 16
+_WIRE_FLAG_FULL = 0x1
+
+
+class GallerySnapshot(NamedTuple):
+    """
+    Immutable view of the gallery at a given version.
+    One row per face template; the rows of a user are contiguous. Rows of
+    replaced or deleted templates stay in place, owned by TOMBSTONE, until
+    the gallery is compacted.
+    """
+    version: int
+    user_ids: np.ndarray  # (N,) int64, owner of each row (TOMBSTONE if dead)
+    names: List[str]
+    image_paths: List[Optional[str]]  # API image URL per row (or None)
+    encodings: Union[np.ndarray, GalleryMatrix]  # (N, 128) float32
+    segment_starts: np.ndarray  # (S,) first row of each block (dead blocks included), for np.minimum.reduceat
+    layout_version: int  # Changes only when rows are renumbered (load, adoption, compaction)
+    ann: Optional[IVFIndex]  # Approximate index covering exactly these rows, if any
+
+
+class PublishedGallery(NamedTuple):
+    """Full gallery read from a snapshot file, with its matrix memory-mapped"""
+    version: int
+    user_ids: np.ndarray  # (N,) int64
+    names: List[str]
+    image_paths: List[Optional[str]]
+    encodings: np.ndarray  # (N, 128) float32, read-only view of the file
+    file_id: Tuple[int, int]  # (inode, mtime) of the file, to notice replacements
+
+
+class GalleryDelta(NamedTuple):
+    """Rows added/updated and user ids deleted between two gallery versions"""
+    version: int
+    full: bool  # True when the client must replace its whole gallery
+    rows: List[int]  # Row indexes into snapshot
+    deleted: List[int]
+    snapshot: GallerySnapshot
+
+
+def record_gallery_change(db: Session, user_id: int, op: str) -> int:
+    """
+    Append a change log entry in the caller's transaction.
+    Returns its id, which becomes the gallery version once committed.
+    """
+    change = GalleryChange(user_id=user_id, op=op)
+    db.add(change)
+    db.flush()
+    return change.id
+
+
+def gallery_etag(version: int, representation: str = "json") -> str:
+    """HTTP entity tag for a gallery version in one representation ("json", "binary", "binary-gzip")"""
+    return f'"gallery-{version}-{representation}"'
+
+
+def _wire_prefix(
+    version: int,
+    full: bool,
+    user_ids: List[int],
+    names: List[str],
+    image_paths: List[Optional[str]],
+    deleted: List[int]
+) -> bytes:
+    """Header, index and padding of a wire payload - everything before the matrix"""
+    index = json.dumps({
+        "user_ids": user_ids,
+        "names": names,
+        "image_paths": image_paths,
+        "deleted": deleted,
+    }, ensure_ascii=False).encode("utf-8")
+
+    header = _WIRE_HEADER.pack(
+        _WIRE_MAGIC, WIRE_FORMAT_VERSION, _WIRE_FLAG_FULL if full else 0,
+        version, len(user_ids), ENCODING_DIM, len(index)
+    )
+    padding = -(len(header) + len(index)) % _WIRE_ALIGN
+    return b"".join((header, index, b"\0" * padding))
+
+
+def encode_gallery_binary(delta: GalleryDelta) -> bytes:
+    """Serialize a gallery delta (or full gallery) to the binary wire format"""
+    snapshot = delta.snapshot
+    rows = delta.rows
+    prefix = _wire_prefix(
+        delta.version, delta.full, snapshot.user_ids[rows].tolist(),
+        [snapshot.names[row] for row in rows], [snapshot.image_paths[row] for row in rows], delta.deleted
+    )
+    matrix = np.ascontiguousarray(snapshot.encodings[rows], dtype=ENCODING_DTYPE)
+    return prefix + matrix.tobytes()
+
+
+def decode_gallery_binary(payload: bytes) -> dict:
+    """
+    Parse the binary wire format (client side helper).
+    The returned "encodings" is a zero-copy (N, dim) view into payload, one
+    row per template: a client applying a delta drops every row it holds
+    for the returned user ids (and the deleted ones) before adding these.
+    """
+    magic, format_version, flags, version, count, dim, index_len = _WIRE_HEADER.unpack_from(payload)
+    if magic != _WIRE_MAGIC:
+        raise ValueError("Not a face gallery payload")
+    if format_version != WIRE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported face gallery format version {format_version}")
+
+    index_start = _WIRE_HEADER.size
+    index = json.loads(bytes(payload[index_start:index_start + index_len]).decode("utf-8"))
+    matrix_start = index_start + index_len
+    matrix_start += -matrix_start % _WIRE_ALIGN
+
+    encodings = np.frombuffer(payload, dtype=ENCODING_DTYPE, count=count * dim, offset=matrix_start)
+    return {
+        "version": version,
+        "full": bool(flags & _WIRE_FLAG_FULL),
+        "user_ids": index["user_ids"],
+        "names": index["names"],
+        "image_paths": index["image_paths"],
+        "deleted": index["deleted"],
+        "encodings": encodings.reshape(count, dim),
+    }
+
+
+def write_gallery_snapshot(path: Path, snapshot: GallerySnapshot):
+    """
+    Write a full gallery (live rows only) to the snapshot file atomically:
+    readers see either the previous file or the complete new one, and
+    processes that mapped the previous file keep a valid mapping until they
+    switch.
+    """
+    rows = live_rows(snapshot)
+    prefix = _wire_prefix(
+        snapshot.version, True, snapshot.user_ids[rows].tolist(),
+        [snapshot.names[row] for row in rows], [snapshot.image_paths[row] for row in rows], []
+    )
+    matrix = np.ascontiguousarray(snapshot.encodings[rows], dtype=ENCODING_DTYPE)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(prefix)
+            f.write(matrix.reshape(-1).view(np.uint8))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _read_snapshot_header(f: BinaryIO) -> Optional[Tuple[int, int, int]]:
+    """(gallery version, row count, index length) of a snapshot file, None if not one"""
+    try:
+        magic, format_version, flags, version, count, dim, index_len = _WIRE_HEADER.unpack(
+            f.read(_WIRE_HEADER.size)
+        )
+    except struct.error:
+        return None
+    if magic != _WIRE_MAGIC or format_version != WIRE_FORMAT_VERSION or dim != ENCODING_DIM:
+        return None
+    if not flags & _WIRE_FLAG_FULL:
+        return None
+    return version, count, index_len
+
+
+def open_gallery_snapshot(path: Path, version: int) -> Optional[BinaryIO]:
+    """The snapshot file opened for reading if it holds exactly this version"""
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    header = _read_snapshot_header(f)
+    if header is None or header[0] != version:
+        f.close()
+        return None
+    f.seek(0)
+    return f
+
+
+def map_gallery_snapshot(path: Path) -> Optional[PublishedGallery]:
+    """Read the index of a snapshot file and memory-map its matrix (None if missing or invalid)"""
+    try:
+        with open(path, "rb") as f:
+            header = _read_snapshot_header(f)
+            if header is None:
+                return None
+            version, count, index_len = header
+            index = json.loads(f.read(index_len).decode("utf-8"))
+            stat = os.fstat(f.fileno())
+
+            matrix_start = _WIRE_HEADER.size + index_len
+            matrix_start += -matrix_start % _WIRE_ALIGN
+            if stat.st_size != matrix_start + count * ENCODING_BYTES:
+                return None
+            if count:
+                # Mapped through the open file, so a concurrent replacement cannot swap it
+                encodings = np.memmap(
+                    f, dtype=ENCODING_DTYPE, mode="r", offset=matrix_start, shape=(count, ENCODING_DIM)
+                ).view(np.ndarray)
+            else:
+                encodings = np.empty((0, ENCODING_DIM), dtype=np.float32)
+    except (OSError, ValueError):
+        return None
+
+    return PublishedGallery(
+        version=version,
+        user_ids=np.asarray(index["user_ids"], dtype=np.int64),
+        names=index["names"],
+        image_paths=index["image_paths"],
+        encodings=encodings,
+        file_id=(stat.st_ino, stat.st_mtime_ns),
+    )
+
+
+def live_rows(snapshot: GallerySnapshot) -> np.ndarray:
+    """Indexes of the rows not tombstoned"""
+    return np.flatnonzero(snapshot.user_ids != TOMBSTONE)
+
+
+def _row_map(keep: np.ndarray) -> np.ndarray:
+    """New row of every row once only the `keep` ones remain, -1 for dropped rows"""
+    row_map = np.cumsum(keep) - 1
+    row_map[~keep] = -1
+    return row_map
+
+
+def user_image_url(user_id: int, image_path: Optional[str]) -> Optional[str]:
+    """Build the public image URL for a user (None if no image stored)"""
+    return f"/api/users/{user_id}/image" if image_path else None
+
+
+class GalleryIndex:
+    """
+    Contiguous float32 (N x 128) matrix of face templates plus parallel
+    owner id/name arrays, loaded once and updated incrementally.
+
+    The templates of a user occupy one contiguous block of rows, so per-user
+    reductions are a single np.minimum.reduceat over segment_starts.
+    The rows are a base matrix (loaded, or mapped from the snapshot file)
+    followed by a private overflow block: appends write into spare capacity
+    of the overflow, never into or over the base. Replacing or deleting a
+    user only tombstones its block (a copy-on-write owner array, the matrix
+    is not touched); dead rows are dropped when the gallery is published, or
+    compacted into a private copy once they exceed a quarter of the rows
+    (half with a snapshot file, as publishing normally drops them first). So a snapshot handed to a reader never changes underneath it. The version number is a gallery_changes id such that every
+    change up to it has been applied, so it survives restarts and can be used
+    for delta sync. Changes applied out of order (this process committing
+    change N+1 before it saw change N of another process) are remembered but
+    do not advance the version until catch_up has applied the gap.
+
+    With FACE_INDEX_TYPE=ivf an approximate IVF index is kept in step with
+    the rows: new rows are assigned to their nearest list, dead rows are
+    skipped at search time and compaction renumbers its rows. A background
+    thread re-clusters it from scratch only once a quarter of its entries
+    changed since training (at most every FACE_IVF_REBUILD_DELAY); the exact
+    scan is only used before the first build.
+
+    The gallery is also published to a snapshot file (GALLERY_SNAPSHOT_PATH)
+    a few seconds after it changes, at most every GALLERY_SNAPSHOT_MIN_INTERVAL.
+    Only the process holding a lock next to the file writes it (another one
+    takes over when it exits); the others only map what it publishes. Every process maps the matrix of that
+    file read-only instead of keeping its own copy, so server workers share
+    one page-cached gallery; a process only holds the overflow rows of
+    changes not published yet privately (peak: those rows, twice while the
+    overflow grows). Other processes adopt a newer file in catch_up, but
+    only one covering every change they applied themselves; the publishing
+    thread catches up with the change log first so its file has no gaps.
+    """
+
+    def __init__(self, snapshot_path: Optional[str] = GALLERY_SNAPSHOT_PATH):
+        self._lock = threading.Lock()
+        self._base = np.empty((0, ENCODING_DIM), dtype=np.float32)  # First rows, read-only (possibly mapped)
+        self._buffer = np.empty((0, ENCODING_DIM), dtype=np.float32)  # Overflow rows after the base, with spare capacity
+        self._size = 0  # Rows in base + overflow
+        self._dead = 0  # Tombstoned rows
+        self._user_ids = np.empty(0, dtype=np.int64)
+        self._names: List[str] = []
+        self._image_paths: List[Optional[str]] = []
+        self._segment_starts = np.empty(0, dtype=np.int64)
+        self._rows: Dict[int, Tuple[int, int]] = {}  # user_id -> (first row, template count)
+        self._version = 0  # Every change log id up to this one is applied
+        self._applied: Set[int] = set()  # Change ids above _version applied out of order
+        self._user_versions: Dict[int, int] = {}  # user_id -> latest change id its rows reflect
+        self._wire_cache: Dict[Tuple[int, bool], bytes] = {}  # (version, gzip) -> full payload
+        self._layout_version = 0
+        self._ann: Optional[IVFIndex] = None  # Kept in step with the rows, refers to rows of layout ann.version
+        self._ann_thread: Optional[threading.Thread] = None
+        self._ann_dirty = False
+        self._snapshot_path = Path(snapshot_path) if snapshot_path else None
+        self._snapshot_file: Optional[Tuple[int, int]] = None  # file_id of the snapshot file last mapped or found stale
+        self._publish_thread: Optional[threading.Thread] = None
+        self._publish_dirty = False
+        self._publish_lock: Optional[BinaryIO] = None  # Held by the one process writing the snapshot file
+        self._published_at = 0.0  # time.monotonic() of the last write
+        self._loaded = False  # Only a loaded (complete) gallery may be published
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def __len__(self) -> int:
+        return self._size - self._dead
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rows
+
+    def template_count(self, user_id: int) -> int:
+        """Number of templates indexed for a user"""
+        block = self._rows.get(user_id)
+        return block[1] if block else 0
+
+    def load(self, db: Session):
+        """(Re)build the whole index from the published snapshot if current, else from the face_templates table"""
+        version = db.query(func.max(GalleryChange.id)).scalar() or 0
+        published = map_gallery_snapshot(self._snapshot_path) if self._snapshot_path else None
+        if published is not None and published.version == version:
+            with self._lock:
+                self._adopt(published)
+                self._loaded = True
+            self.schedule_ann_rebuild()
+            print(f"Gallery mapped from {self._snapshot_path}: {len(self)} templates of {len(self._rows)} users (version {self._version})")
+            return
+
+        # Fetch only the columns needed, never full User rows
+        rows = (
+            db.query(FaceTemplate.user_id, User.name, User.image_path, FaceTemplate.encoding_blob)
+            .join(User, User.id == FaceTemplate.user_id)
+            .order_by(FaceTemplate.user_id, FaceTemplate.id)
+            .all()
+        )
+        rows = [row for row in rows if len(row.encoding_blob) == ENCODING_BYTES]
+
+        user_ids = np.asarray([row.user_id for row in rows], dtype=np.int64)
+        names = [row.name for row in rows]
+        image_paths = [user_image_url(row.user_id, row.image_path) for row in rows]
+
+        # One join + one frombuffer decodes the whole gallery
+        matrix = decode_encoding(b"".join(row.encoding_blob for row in rows)).reshape(-1, ENCODING_DIM)
+
+        with self._lock:
+            self._replace(matrix, user_ids, names, image_paths, version)
+            self._snapshot_file = None
+            self._loaded = True
+
+        self.schedule_ann_rebuild()
+        print(f"Gallery loaded: {len(self)} templates of {len(self._rows)} users (version {self._version})")
+
+        # The publishing process overwrites whatever file is there; the others
+        # keep this private copy until the file catches up with it
+        if self._snapshot_path is not None:
+            try:
+                self.publish(force=True)
+            except Exception as e:
+                print(f"Error publishing gallery snapshot: {e}")
+
+    def upsert(self, user_id: int, name: str, encodings: np.ndarray, image_path: Optional[str], version: int) -> bool:
+        """Replace all templates of a user (adds the user if new); False if the change was already applied"""
+        vectors = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+
+        with self._lock:
+            if not self._mark_applied(user_id, version):
+                return False
+            self._set_user(user_id, name, vectors, image_path)
+        self.schedule_ann_rebuild()
+        self.schedule_publish()
+        return True
+
+    def rename(self, user_id: int, name: str, version: int) -> bool:
+        """Update the display name of an indexed user"""
+        with self._lock:
+            if not self._mark_applied(user_id, version):
+                return False
+            block = self._rows.get(user_id)
+            if block is None:
+                return False
+            start, count = block
+            names = list(self._names)
+            names[start:start + count] = [name] * count
+            self._names = names
+        self.schedule_publish()
+        return True
+
+    def remove(self, user_id: int, version: int) -> bool:
+        """Drop a user and all its templates from the index"""
+        with self._lock:
+            if not self._mark_applied(user_id, version):
+                return False
+            if user_id not in self._rows:
+                return False
+            self._delete_block(user_id)
+        self.schedule_ann_rebuild()
+        self.schedule_publish()
+        return True
+
+    def snapshot(self) -> GallerySnapshot:
+        """Consistent, read-only view of the current gallery"""
+        with self._lock:
+            return GallerySnapshot(
+                version=self._version,
+                user_ids=self._user_ids,
+                names=self._names,
+                image_paths=self._image_paths,
+                encodings=self._matrix(),
+                segment_starts=self._segment_starts,
+                layout_version=self._layout_version,
+                ann=self._ann,
+            )
+
+    def ann_index(self, snapshot: GallerySnapshot) -> Optional[IVFIndex]:
+        """The approximate index covering the rows of this snapshot, if any"""
+        return snapshot.ann
+
+    def schedule_ann_rebuild(self):
+        """Ask the background thread to (re)build the IVF index if it is missing or drifted too far"""
+        if FACE_INDEX_TYPE != "ivf":
+            return
+        with self._lock:
+            if not self._ann_needs_rebuild():
+                return
+            self._ann_dirty = True
+            if self._ann_thread is None:
+                self._ann_thread = threading.Thread(target=self._ann_rebuild_loop, name="gallery-ann", daemon=True)
+                self._ann_thread.start()
+
+    def _ann_needs_rebuild(self) -> bool:
+        """(lock held)"""
+        ann = self._ann
+        if len(self) < FACE_IVF_MIN_SIZE:
+            return ann is not None
+        return ann is None or ann.drift() > IVF_MAX_DRIFT
+
+    def _ann_rebuild_loop(self):
+        """
+        Re-cluster from the live rows while the index is missing or drifted,
+        at most every FACE_IVF_REBUILD_DELAY. Rows appended during a build are
+        added to the new index before it is swapped in.
+        """
+        while True:
+            with self._lock:
+                if not self._ann_dirty or not self._ann_needs_rebuild():
+                    self._ann_dirty = False
+                    self._ann_thread = None
+                    return
+                self._ann_dirty = False
+
+            snapshot = self.snapshot()
+            rows = live_rows(snapshot)
+            if len(rows) < FACE_IVF_MIN_SIZE:
+                with self._lock:
+                    self._ann = None
+                continue
+            try:
+                ann = IVFIndex.build(
+                    snapshot.encodings[rows], FACE_IVF_NLIST, FACE_IVF_NPROBE, snapshot.layout_version,
+                    row_ids=rows
+                )
+                with self._lock:
+                    if ann.version == self._layout_version:
+                        built = len(snapshot.user_ids)
+                        if self._size > built:
+                            ann = ann.add(self._matrix()[built:self._size], np.arange(built, self._size))
+                        self._ann = ann
+                    else:
+                        # Rows were renumbered meanwhile: build again
+                        self._ann_dirty = True
+            except Exception as e:
+                print(f"Error building IVF index: {e}")
+            time.sleep(FACE_IVF_REBUILD_DELAY)
+
+    def schedule_publish(self):
+        """Ask the background thread to rewrite the snapshot file"""
+        if self._snapshot_path is None or not self._loaded:
+            return
+        with self._lock:
+            self._publish_dirty = True
+            if self._publish_thread is None:
+                self._publish_thread = threading.Thread(target=self._publish_loop, name="gallery-publish", daemon=True)
+                self._publish_thread.start()
+
+    def _publish_loop(self):
+        """
+        Publish after GALLERY_SNAPSHOT_DELAY without changes, so bursts are
+        written once, and no sooner than GALLERY_SNAPSHOT_MIN_INTERVAL after
+        the previous write (changes meanwhile stay in the overflow rows)
+        """
+        while True:
+            time.sleep(max(GALLERY_SNAPSHOT_DELAY, self._published_at + GALLERY_SNAPSHOT_MIN_INTERVAL - time.monotonic()))
+            with self._lock:
+                if not self._publish_dirty:
+                    self._publish_thread = None
+                    return
+                self._publish_dirty = False
+            try:
+                # Fill gaps left by out-of-order changes so the file covers all of them
+                db = SessionLocal()
+                try:
+                    self.catch_up(db)
+                finally:
+                    db.close()
+                self.publish()
+            except Exception as e:
+                print(f"Error publishing gallery snapshot: {e}")
+
+    def publish(self, force: bool = False):
+        """
+        Write the current gallery to the snapshot file and switch this process
+        to the mapped matrix. Skipped when the file already holds this version
+        or a newer one (unless forced), and in processes not holding the
+        publish lock: those only switch to the file if it caught up.
+        """
+        snapshot = self.snapshot()
+        publisher = self._acquire_publish_lock()
+        if not force or not publisher:
+            published = map_gallery_snapshot(self._snapshot_path)
+            if published is not None and published.version >= snapshot.version:
+                self._use_published(published)
+                return
+            if not publisher:
+                return
+
+        write_gallery_snapshot(self._snapshot_path, snapshot)
+        self._published_at = time.monotonic()
+        # Map the file by path: another process may have replaced it meanwhile
+        published = map_gallery_snapshot(self._snapshot_path)
+        if published is not None:
+            self._use_published(published)
+
+    def _acquire_publish_lock(self) -> bool:
+        """Whether this process writes the snapshot file, taking the lock if no other process holds it"""
+        if self._publish_lock is not None or fcntl is None:
+            return True
+        self._snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self._snapshot_path.with_name(self._snapshot_path.name + ".lock"), "wb")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._publish_lock = lock_file
+        print(f"Gallery snapshot {self._snapshot_path} is published by this process")
+        return True
+
+    def _sync_snapshot(self, latest: int) -> bool:
+        """
+        Switch to the snapshot file if another process published a newer
+        gallery (up to version `latest`), or the same one while this process
+        still holds a private copy. Costs one stat when nothing changed.
+        """
+        if self._snapshot_path is None:
+            return False
+        try:
+            stat = self._snapshot_path.stat()
+        except OSError:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns) == self._snapshot_file:
+            return False
+
+        published = map_gallery_snapshot(self._snapshot_path)
+        if published is None or published.version > latest:
+            return False
+        adopted = self._use_published(published)
+        self._snapshot_file = published.file_id
+        return adopted
+
+    def _use_published(self, published: PublishedGallery) -> bool:
+        """
+        Adopt a newer published gallery, or map the matrix of the current one;
+        True if adopted. Never switches to a file missing changes applied here
+        (including ones applied out of order above the version).
+        """
+        with self._lock:
+            if published.version < max(self._applied, default=self._version):
+                return False
+            if published.version == self._version:
+                if np.array_equal(published.user_ids, self._user_ids):
+                    # Same rows in the same order: the file replaces base and overflow
+                    self._base = published.encodings
+                    self._buffer = np.empty((0, ENCODING_DIM), dtype=np.float32)
+                    self._snapshot_file = published.file_id
+                    return False
+                keep = self._user_ids != TOMBSTONE
+                if np.array_equal(published.user_ids, self._user_ids[keep]):
+                    # This gallery published without its dead rows: switching is a compaction
+                    ann = self._ann
+                    self._adopt(published)
+                    if ann is not None:
+                        self._ann = ann.remap(_row_map(keep), self._layout_version)
+                    return False
+            self._adopt(published)
+        self.schedule_ann_rebuild()
+        return True
+
+    def catch_up(self, db: Session) -> bool:
+        """
+        Apply changes committed by other processes (e.g. scripts/bulk_enroll.py)
+        that this index has not seen yet: the published snapshot file first,
+        then every change log entry above the version not applied yet, gaps
+        left by out-of-order changes included. Costs one indexed query and
+        one stat when up to date.
+        """
+        latest = db.query(func.max(GalleryChange.id)).scalar() or 0
+        adopted = self._sync_snapshot(latest)
+        with self._lock:
+            version, applied = self._version, set(self._applied)
+        if latest <= version:
+            return adopted
+
+        user_ids = list({
+            user_id for change_id, user_id in
+            db.query(GalleryChange.id, GalleryChange.user_id)
+            .filter(GalleryChange.id > version, GalleryChange.id <= latest)
+            if change_id not in applied
+        })
+        users = {
+            row.id: row for row in
+            db.query(User.id, User.name, User.image_path)
+            .filter(User.id.in_(user_ids))
+            .all()
+        }
+        templates: Dict[int, List[np.ndarray]] = {}
+        for user_id, blob in (
+            db.query(FaceTemplate.user_id, FaceTemplate.encoding_blob)
+            .filter(FaceTemplate.user_id.in_(user_ids))
+            .order_by(FaceTemplate.user_id, FaceTemplate.id)
+        ):
+            if len(blob) == ENCODING_BYTES:
+                templates.setdefault(user_id, []).append(decode_encoding(blob))
+
+        with self._lock:
+            for user_id in user_ids:
+                # Rows applied meanwhile from a newer change are fresher than this read
+                if self._user_versions.get(user_id, 0) > latest:
+                    continue
+                row = users.get(user_id)
+                if row is not None and user_id in templates:
+                    self._set_user(row.id, row.name, np.stack(templates[user_id]),
+                                   user_image_url(row.id, row.image_path))
+                elif user_id in self._rows:
+                    self._delete_block(user_id)
+                self._user_versions[user_id] = latest
+            # Everything committed up to latest is applied now
+            self._version = max(self._version, latest)
+            self._applied = {change_id for change_id in self._applied if change_id > self._version}
+        self.schedule_ann_rebuild()
+        self.schedule_publish()
+        return True
+
+    def changes_since(self, db: Session, since: Optional[int]) -> GalleryDelta:
+        """
+        Compute what a client at gallery version `since` needs to catch up.
+        Falls back to a full gallery when `since` is missing or unknown.
+        """
+        snapshot = self.snapshot()
+
+        if since is None or since > snapshot.version:
+            return GalleryDelta(snapshot.version, True, live_rows(snapshot).tolist(), [], snapshot)
+
+        if since == snapshot.version:
+            return GalleryDelta(snapshot.version, False, [], [], snapshot)
+
+        # Only the last operation per user matters
+        changes = (
+            db.query(GalleryChange.user_id, GalleryChange.op)
+            .filter(GalleryChange.id > since, GalleryChange.id <= snapshot.version)
+            .order_by(GalleryChange.id)
+            .all()
+        )
+        last_ops = {user_id: op for user_id, op in changes}
+
+        upserted = [user_id for user_id, op in last_ops.items() if op == CHANGE_UPSERT]
+        rows = np.flatnonzero(np.isin(snapshot.user_ids, upserted)).tolist()
+
+        # Anything changed but no longer in the gallery is reported as deleted
+        present = set(snapshot.user_ids[rows].tolist())
+        deleted = [user_id for user_id in last_ops if user_id not in present]
+
+        return GalleryDelta(snapshot.version, False, rows, deleted, snapshot)
+
+    def open_published(self, version: int) -> Optional[BinaryIO]:
+        """The snapshot file, opened, if it holds this version - it is a full uncompressed wire payload"""
+        if self._snapshot_path is None:
+            return None
+        return open_gallery_snapshot(self._snapshot_path, version)
+
+    def binary_payload(self, delta: GalleryDelta, compress: bool = False) -> bytes:
+        """
+        Binary wire payload for a delta, optionally gzip compressed.
+        Full galleries are built once per version and served from cache.
+        """
+        if not delta.full:
+            payload = encode_gallery_binary(delta)
+            return gzip.compress(payload, mtime=0) if compress else payload
+
+        key = (delta.version, compress)
+        with self._lock:
+            payload = self._wire_cache.get(key)
+        if payload is not None:
+            return payload
+
+        payload = encode_gallery_binary(delta)
+        if compress:
+            payload = gzip.compress(payload, mtime=0)
+
+        with self._lock:
+            # Only keep payloads for the current version
+            if delta.version == self._version:
+                self._wire_cache = {k: v for k, v in self._wire_cache.items() if k[0] == self._version}
+                self._wire_cache[key] = payload
+        return payload
+
+    def _replace(
+        self,
+        matrix: np.ndarray,
+        user_ids: np.ndarray,
+        names: List[str],
+        image_paths: List[Optional[str]],
+        version: int
+    ):
+        """Swap in a whole new gallery (lock held)"""
+        self._base = matrix
+        self._buffer = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        self._size = len(user_ids)
+        self._dead = 0
+        self._user_ids = user_ids
+        self._names = names
+        self._image_paths = image_paths
+        self._reindex()
+        self._ann = None
+        self._version = version
+        self._applied = set()
+        self._user_versions = {}
+
+    def _adopt(self, published: PublishedGallery):
+        """Switch to a gallery published by a snapshot file (lock held)"""
+        self._replace(published.encodings, published.user_ids, published.names, published.image_paths, published.version)
+        self._snapshot_file = published.file_id
+
+    def _mark_applied(self, user_id: int, version: int) -> bool:
+        """
+        Record change log entry `version` of a user as applied; False if it
+        already was, or the user's rows already reflect a newer change (lock held).
+        The version only advances over a contiguous run of applied ids.
+        """
+        if version <= self._version or version in self._applied:
+            return False
+        self._applied.add(version)
+        while self._version + 1 in self._applied:
+            self._version += 1
+            self._applied.remove(self._version)
+        if self._user_versions.get(user_id, 0) >= version:
+            return False
+        self._user_versions[user_id] = version
+        return True
+
+    def _set_user(self, user_id: int, name: str, vectors: np.ndarray, image_path: Optional[str]):
+        """Replace all rows of a user (lock held)"""
+        if user_id in self._rows:
+            self._delete_block(user_id)
+        if len(vectors) > 0:
+            self._append_block(user_id, name, vectors, image_path)
+
+    def _matrix(self) -> Union[np.ndarray, GalleryMatrix]:
+        """Read-only view of every row: the base, plus the overflow when it has rows (lock held)"""
+        overflow = self._buffer[:self._size - len(self._base)]
+        if not len(overflow):
+            return self._base
+        overflow.flags.writeable = False
+        return GalleryMatrix((self._base, overflow))
+
+    def _append_block(self, user_id: int, name: str, vectors: np.ndarray, image_path: Optional[str]):
+        """Append a user's templates to the overflow, growing it geometrically (lock held)"""
+        used = self._size - len(self._base)
+        needed = self._size + len(vectors)
+        if used + len(vectors) > len(self._buffer):
+            capacity = max(64, len(self._buffer) * 2, used + len(vectors))
+            buffer = np.empty((capacity, ENCODING_DIM), dtype=np.float32)
+            buffer[:used] = self._buffer[:used]
+            self._buffer = buffer
+        self._buffer[used:used + len(vectors)] = vectors
+        self._user_ids = np.append(self._user_ids, np.full(len(vectors), user_id, dtype=np.int64))
+        self._names = self._names + [name] * len(vectors)
+        self._image_paths = self._image_paths + [image_path] * len(vectors)
+        self._segment_starts = np.append(self._segment_starts, np.int64(self._size))
+        self._rows[user_id] = (self._size, len(vectors))
+        if self._ann is not None:
+            self._ann = self._ann.add(vectors, np.arange(self._size, needed))
+        self._size = needed
+
+    def _delete_block(self, user_id: int):
+        """Tombstone a user's rows, compacting once too many are dead (lock held)"""
+        start, count = self._rows.pop(user_id)
+        user_ids = self._user_ids.copy()
+        user_ids[start:start + count] = TOMBSTONE
+        self._user_ids = user_ids
+        self._dead += count
+        if self._ann is not None:
+            self._ann = self._ann.discard(count)
+        # Publishing drops dead rows without a private copy, so with a snapshot
+        # file compaction is only a fallback for when that does not happen
+        publishing = self._snapshot_path is not None and self._loaded
+        if self._dead * (2 if publishing else 4) > self._size:
+            self._compact()
+
+    def _compact(self):
+        """Drop tombstoned rows, copying the live ones (lock held)"""
+        keep = self._user_ids != TOMBSTONE
+        ann = self._ann
+        self._base = self._matrix()[np.flatnonzero(keep)]
+        self._buffer = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        self._user_ids = self._user_ids[keep]
+        self._names = [name for name, alive in zip(self._names, keep) if alive]
+        self._image_paths = [path for path, alive in zip(self._image_paths, keep) if alive]
+        self._size = len(self._user_ids)
+        self._dead = 0
+        self._reindex()
+        if ann is not None:
+            self._ann = ann.remap(_row_map(keep), self._layout_version)
+
+    def _reindex(self):
+        """Recompute user blocks from the owner array (lock held)"""
+        self._layout_version += 1
+        user_ids = self._user_ids
+        if len(user_ids) == 0:
+            self._segment_starts = np.empty(0, dtype=np.int64)
+            self._rows = {}
+            return
+        starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]])
+        counts = np.diff(np.r_[starts, len(user_ids)])
+        self._segment_starts = starts.astype(np.int64)
+        self._rows = dict(zip(user_ids[starts].tolist(), zip(starts.tolist(), counts.tolist())))
+
+
+# Process-wide gallery instance
+gallery = GalleryIndex()
@@ -0,0 +1,134 @@
+"""
+Presence service - live "checked in today" tracking
+"""
+import asyncio
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, AttendanceDaily
+from app.services.stats_service import UNKNOWN_USER_ID
+from app.services.user_directory import user_directory
+from app.utils import now_gmt7
+
+
+class PresenceTracker:
+    """
+    Set of users with a successful scan on the current GMT+7 day; together
+    with the user directory (the roster) it answers "who is in / who is
+    not" without touching the database.
+
+    Loaded from the daily rollup at startup and again at every GMT+7
+    midnight; scans recorded by this process update it in O(1).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day: Optional[date] = None
+        self._checked_in: Set[int] = set()
+        self._lists: Optional[Tuple[List[str], List[str]]] = None  # Sorted name lists, built lazily
+        self._lists_version: Optional[int] = None  # Directory version the lists were built from
+
+    @property
+    def day(self) -> Optional[date]:
+        return self._day
+
+    @property
+    def total_users(self) -> int:
+        return len(user_directory)
+
+    @property
+    def checked_in_count(self) -> int:
+        return len(self._checked_in)
+
+    def load(self, db: Session, day: Optional[date] = None):
+        """Rebuild today's check-ins from the daily rollup"""
+        day = day or now_gmt7().date()
+        checked_in = {
+            user_id for (user_id,) in db.query(AttendanceDaily.user_id).filter(
+                AttendanceDaily.day == day,
+                AttendanceDaily.status == 'success',
+                AttendanceDaily.user_id != UNKNOWN_USER_ID
+            )
+        }
+
+        with self._lock:
+            self._day = day
+            self._checked_in = checked_in
+            self._lists = None
+
+        print(f"Presence loaded for {day}: {len(self._checked_in)} of {len(user_directory)} users checked in")
+
+    def check_in(self, user_id: int, timestamp: datetime) -> bool:
+        """
+        Mark a user present for the day of the scan
+
+        Returns:
+            True if this is the user's first check-in of the current day
+        """
+        day = timestamp.date()
+        with self._lock:
+            if self._day is None or day > self._day:
+                # First scan after midnight, before the scheduled reload
+                self._day = day
+                self._checked_in = set()
+                self._lists = None
+            if day != self._day or user_id not in user_directory or user_id in self._checked_in:
+                return False
+            self._checked_in.add(user_id)
+            self._lists = None
+            return True
+
+    def remove_user(self, user_id: int):
+        """Forget a deleted user"""
+        with self._lock:
+            self._checked_in.discard(user_id)
+            self._lists = None
+
+    def name_lists(self) -> Tuple[List[str], List[str]]:
+        """(checked in, not checked in) user names, sorted alphabetically"""
+        with self._lock:
+            if self._lists is None or self._lists_version != user_directory.version:
+                self._lists_version = user_directory.version
+                checked_in, not_checked_in = [], []
+                for user_id, entry in user_directory.items():
+                    (checked_in if user_id in self._checked_in else not_checked_in).append(entry.name)
+                self._lists = (sorted(checked_in), sorted(not_checked_in))
+            return self._lists
+
+    def delta(self, user_id: int) -> Dict:
+        """WebSocket payload announcing a user's first check-in of the day"""
+        return {
+            "day": self._day.isoformat() if self._day else None,
+            "user_id": user_id,
+            "user_name": user_directory.name(user_id),
+            "checked_in_today": len(self._checked_in),
+            "total_users": len(user_directory)
+        }
+
+    def reload(self):
+        """Reload, roster included, from a fresh session (runs in a worker thread)"""
+        db = SessionLocal()
+        try:
+            # Also picks up users changed outside the server (e.g. scripts)
+            user_directory.load(db)
+            self.load(db)
+        finally:
+            db.close()
+
+    async def run_daily_reset(self):
+        """Reload at every GMT+7 midnight until cancelled"""
+        while True:
+            now = now_gmt7()
+            next_midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            await asyncio.sleep((next_midnight - now).total_seconds() + 1)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                print(f"Error reloading presence: {e}")
+
+
+# Process-wide presence tracker
+presence = PresenceTracker()
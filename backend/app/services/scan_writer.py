@@ -0,0 +1,240 @@
+"""
+Scan writer - group-commit write-behind queue for attendance scans
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks
+    fcntl = None
+
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+from app.config import (
+    SCAN_JOURNAL_PATH, SCAN_FLUSH_INTERVAL_MS, SCAN_FLUSH_MAX_BATCH, WEB_CONCURRENCY, WS_BACKPLANE
+)
+from app.database import SessionLocal, Attendance
+from app.services.stats_service import record_daily_rollup
+
+
+class ScanWriter:
+    """
+    Write-behind queue for attendance scans
+
+    A submitted scan gets its id right away (allocated in memory after the
+    highest id in the database), is appended to a local journal and queued;
+    a background task then inserts the queue in one transaction every
+    flush interval or as soon as max_batch scans are waiting. After each
+    committed batch the journal is rewritten with only the scans still
+    queued, and it is replayed at the next start after a crash, so
+    acknowledged scans are never lost.
+
+    Ids are allocated by this process, so while enabled it must be the only
+    one writing attendance records and every insert must go through it:
+    start() refuses to enable it when several server processes are
+    configured, and holds a lock next to the journal against a second
+    server started on the same data.
+    """
+
+    def __init__(
+        self,
+        journal_path: Path = SCAN_JOURNAL_PATH,
+        flush_interval_ms: int = SCAN_FLUSH_INTERVAL_MS,
+        max_batch: int = SCAN_FLUSH_MAX_BATCH
+    ):
+        self.journal_path = Path(journal_path)
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.enabled = False
+        self._queue: List[Dict] = []
+        self._next_id = 1
+        self._journal = None
+        self._lock_file = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def pending(self) -> int:
+        """Scans acknowledged but not committed yet"""
+        return len(self._queue)
+
+    def start(self):
+        """Replay the journal, allocate ids after the database and start flushing"""
+        if WEB_CONCURRENCY > 1 or WS_BACKPLANE != "memory":
+            print("✗ Scan write-behind needs a single server process (WEB_CONCURRENCY=1, WS_BACKPLANE=memory), disabled")
+            return
+
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.journal_path.with_name(self.journal_path.name + ".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                self._lock_file = None
+                raise RuntimeError(f"Scan write-behind is already running on {self.journal_path} in another process")
+
+        db = SessionLocal()
+        try:
+            self._replay(db)
+            self._next_id = (db.query(func.max(Attendance.id)).scalar() or 0) + 1
+        finally:
+            db.close()
+
+        self._journal = open(self.journal_path, "w", encoding="utf-8")
+        self._queue = []
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+        self.enabled = True
+        print(f"Scan write-behind started (flush every {self.flush_interval * 1000:.0f} ms or {self.max_batch} scans)")
+
+    async def stop(self):
+        """Stop accepting scans and drain the queue"""
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._journal.close()
+        if self._queue:
+            print(f"✗ {len(self._queue)} scans could not be committed, kept in {self.journal_path}")
+        else:
+            self.journal_path.unlink(missing_ok=True)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def submit(self, scans: List[Dict]) -> List[Dict]:
+        """
+        Acknowledge new scans
+
+        Args:
+            scans: Dicts of Attendance columns (user_id, timestamp as naive
+                GMT+7 datetime, status, device_id)
+
+        Returns:
+            The scans with their allocated ids, in the same order
+        """
+        rows = []
+        for scan in scans:
+            rows.append({**scan, "id": self._next_id})
+            self._next_id += 1
+
+        # Journal first: flushed to the OS, so it survives a process crash
+        self._journal.write(self._journal_lines(rows))
+        self._journal.flush()
+
+        self._queue.extend(rows)
+        if len(self._queue) >= self.max_batch:
+            self._wakeup.set()
+        return rows
+
+    async def flush(self):
+        """Commit everything queued so far in one transaction"""
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            print(f"Error committing {len(batch)} scans, will retry: {e}")
+            self._queue = batch + self._queue
+            return
+
+        self._rotate_journal()
+
+    def _rotate_journal(self):
+        """
+        Drop the committed scans from the journal, keeping only the ones
+        queued since (batches commit in id order, so those are the rest)
+        """
+        if not self._queue:
+            self._journal.seek(0)
+            self._journal.truncate()
+            return
+
+        # A crash before the rename leaves the old journal, which replay handles
+        rotated = self.journal_path.with_name(self.journal_path.name + ".tmp")
+        with open(rotated, "w", encoding="utf-8") as f:
+            f.write(self._journal_lines(self._queue))
+        self._journal.close()
+        os.replace(rotated, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    @staticmethod
+    def _write(batch: List[Dict], db: Optional[Session] = None):
+        """Insert a batch and its rollup increments in one transaction"""
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            db.execute(insert(Attendance), batch)
+            record_daily_rollup(db, [Attendance(**row) for row in batch])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            if own_session:
+                db.close()
+
+    def _replay(self, db: Session):
+        """Commit journaled scans missing from the database after a crash"""
+        if not self.journal_path.exists():
+            return
+
+        rows = []
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(self._deserialize(json.loads(line)))
+                except (ValueError, KeyError):
+                    # Torn last line of a crash mid-write, never acknowledged
+                    continue
+
+        # Batches commit in id order, so the committed scans are a prefix
+        committed_id = db.query(func.max(Attendance.id)).scalar() or 0
+        missing = [row for row in rows if row["id"] > committed_id]
+        if missing:
+            self._write(missing, db)
+            print(f"Replayed {len(missing)} journaled scans")
+        self.journal_path.unlink()
+
+    @classmethod
+    def _journal_lines(cls, rows: List[Dict]) -> str:
+        return "".join(json.dumps(cls._serialize(row)) + "\n" for row in rows)
+
+    @staticmethod
+    def _serialize(row: Dict) -> Dict:
+        return {**row, "timestamp": row["timestamp"].isoformat()}
+
+    @staticmethod
+    def _deserialize(data: Dict) -> Dict:
+        return {
+            "id": data["id"],
+            "user_id": data["user_id"],
+            "timestamp": datetime.fromisoformat(data["timestamp"]),
+            "status": data["status"],
+            "device_id": data["device_id"]
+        }
+
+
+# Process-wide scan writer (only started when SCAN_WRITE_BEHIND is enabled)
+scan_writer = ScanWriter()
@@ -0,0 +1,120 @@
+"""
+Settings service - cached system settings
+"""
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import SETTINGS_REVALIDATE_INTERVAL
+from app.database import SessionLocal, Settings
+
+# Values of the row created when none exists yet
+DEFAULT_THRESHOLD = 0.6
+DEFAULT_CAMERA_ID = 0
+
+
+class SystemSettings(NamedTuple):
+    """Immutable copy of the settings row"""
+    id: int
+    threshold: float
+    camera_id: int
+    revision: int
+
+
+def settings_etag(settings: SystemSettings) -> str:
+    """HTTP entity tag derived from the values, identical in every server process"""
+    digest = hashlib.sha1(repr(tuple(settings)).encode("utf-8")).hexdigest()[:16]
+    return f'"settings-{digest}"'
+
+
+def get_or_create_settings(db: Session) -> Settings:
+    """The settings row, created with default values if none exists"""
+    settings = db.query(Settings).first()
+    if not settings:
+        settings = Settings(threshold=DEFAULT_THRESHOLD, camera_id=DEFAULT_CAMERA_ID, revision=0)
+        db.add(settings)
+        db.commit()
+        db.refresh(settings)
+    return settings
+
+
+def to_system_settings(settings: Settings) -> SystemSettings:
+    return SystemSettings(
+        id=settings.id, threshold=settings.threshold, camera_id=settings.camera_id, revision=settings.revision
+    )
+
+
+class SettingsCache:
+    """
+    The settings row, read once and kept in memory so kiosk polling and
+    server-side matching never query the table. The settings router
+    replaces it after an update; other server processes receive the new
+    values with the "settings" WebSocket broadcast. Every update increments
+    the row's revision, so a late broadcast never replaces newer values, and
+    run_revalidation() rereads the row whenever its revision moved on
+    without a broadcast reaching this process (e.g. several workers with
+    WS_BACKPLANE=memory).
+    """
+
+    def __init__(self):
+        self._settings: Optional[SystemSettings] = None
+
+    def load(self, db: Session) -> SystemSettings:
+        """(Re)read the settings row"""
+        return self.set(to_system_settings(get_or_create_settings(db)))
+
+    def get(self) -> SystemSettings:
+        """Current settings, loaded on first use if startup did not"""
+        settings = self._settings
+        if settings is None:
+            db = SessionLocal()
+            try:
+                settings = self.load(db)
+            finally:
+                db.close()
+        return settings
+
+    def set(self, settings: SystemSettings) -> SystemSettings:
+        """
+        Replace the cached settings (after an update here or in another
+        process) unless they are older than the cached ones; returns the
+        settings now cached
+        """
+        current = self._settings
+        if current is not None and settings.revision < current.revision:
+            return current
+        self._settings = settings
+        return settings
+
+    def revalidate(self) -> Optional[SystemSettings]:
+        """Reload if the row's revision is ahead of the cached one (one single-column read); the new settings or None"""
+        db = SessionLocal()
+        try:
+            revision = db.query(Settings.revision).order_by(Settings.id).limit(1).scalar()
+            current = self._settings
+            if revision is None or (current is not None and revision <= current.revision):
+                return None
+            return self.load(db)
+        finally:
+            db.close()
+
+    async def run_revalidation(
+        self,
+        on_change: Callable[[SystemSettings], Awaitable[None]],
+        interval: float = SETTINGS_REVALIDATE_INTERVAL
+    ):
+        """Revalidate every `interval` seconds until cancelled, calling on_change with reloaded settings"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                settings = await asyncio.to_thread(self.revalidate)
+                if settings is not None:
+                    await on_change(settings)
+            except Exception as e:
+                print(f"Error revalidating settings: {e}")
+
+
+# Process-wide settings cache
+settings_cache = SettingsCache()
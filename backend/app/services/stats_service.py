@@ -0,0 +1,99 @@
+"""
+Attendance statistics service - incremental daily rollups
+"""
+from collections import Counter
+from typing import Dict, Iterable, List
+
+from sqlalchemy import insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.database import Attendance, AttendanceDaily
+
+UNKNOWN_USER_ID = 0  # Rollup user_id of scans without a user
+
+
+def rollup_counts(attendances: Iterable[Attendance]) -> List[Dict]:
+    """Aggregate new attendance records into rollup increments"""
+    counts = Counter(
+        (attendance.timestamp.date(), attendance.user_id or UNKNOWN_USER_ID, attendance.status)
+        for attendance in attendances
+    )
+    return [
+        {"day": day, "user_id": user_id, "status": status, "count": count}
+        for (day, user_id, status), count in counts.items()
+    ]
+
+
+def rollup_upsert_statement(dialect_name: str, counts: List[Dict]):
+    """
+    INSERT ... ON CONFLICT statement adding the increments to the rollup
+    (None if the dialect has no upsert)
+    """
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(AttendanceDaily).values(counts)
+        return statement.on_duplicate_key_update(count=AttendanceDaily.count + statement.inserted["count"])
+    else:
+        return None
+    
+    statement = insert(AttendanceDaily).values(counts)
+    return statement.on_conflict_do_update(
+        index_elements=[AttendanceDaily.day, AttendanceDaily.user_id, AttendanceDaily.status],
+        set_={"count": AttendanceDaily.count + statement.excluded["count"]}
+    )
+
+
+def _rollup_increment(increment: Dict):
+    """UPDATE adding one increment to an existing rollup row (upsert fallback)"""
+    return update(AttendanceDaily).where(
+        AttendanceDaily.day == increment["day"],
+        AttendanceDaily.user_id == increment["user_id"],
+        AttendanceDaily.status == increment["status"]
+    ).values(count=AttendanceDaily.count + increment["count"])
+
+
+def record_daily_rollup(db: Session, attendances: Iterable[Attendance]):
+    """
+    Count new attendance records in the daily rollup, in the caller's
+    transaction so the rollup commits (or rolls back) with the records
+    """
+    counts = rollup_counts(attendances)
+    if not counts:
+        return
+    
+    statement = rollup_upsert_statement(db.get_bind().dialect.name, counts)
+    if statement is not None:
+        db.execute(statement)
+        return
+    
+    # Generic fallback: update, insert when missing
+    for increment in counts:
+        if not db.execute(_rollup_increment(increment)).rowcount:
+            db.execute(insert(AttendanceDaily).values(**increment))
+
+
+async def record_daily_rollup_async(db: AsyncSession, attendances: Iterable[Attendance]):
+    """record_daily_rollup for an async session"""
+    counts = rollup_counts(attendances)
+    if not counts:
+        return
+    
+    statement = rollup_upsert_statement(db.bind.dialect.name, counts)
+    if statement is not None:
+        await db.execute(statement)
+        return
+    
+    # Generic fallback: update, insert when missing
+    for increment in counts:
+        if not (await db.execute(_rollup_increment(increment))).rowcount:
+            await db.execute(insert(AttendanceDaily).values(**increment))
+
+
+def remove_user_rollup(db: Session, user_id: int):
+    """Drop the rollup rows of a user whose attendance records are being deleted"""
+    db.query(AttendanceDaily).filter(AttendanceDaily.user_id == user_id).delete(synchronize_session=False)
@@ -0,0 +1,121 @@
+"""
+User directory - in-memory id -> name/code lookups
+"""
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.database import User
+
+
+class UserEntry(NamedTuple):
+    """What attendance, stats and presence need to know about a user"""
+    name: str
+    code: str
+    has_encoding: bool
+
+
+def _entries_query():
+    """id, name, code and has_encoding of users, without loading the encoding columns"""
+    return select(User.id, User.name, User.code, User.has_encoding)
+
+
+class UserDirectory:
+    """
+    id -> (name, code, has_encoding) of every user, loaded once at startup
+    (without the encoding columns) and kept in step by the users router,
+    so recording scans and listing attendance never query the users table.
+    Ids missing from it (users created by another process) are fetched
+    once with fetch_missing and kept.
+
+    `version` changes on every update, for callers caching derived data.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[int, UserEntry] = {}
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def load(self, db: Session):
+        """Rebuild the directory from the users table"""
+        entries = {
+            user_id: UserEntry(name, code, bool(encoded))
+            for user_id, name, code, encoded in db.execute(_entries_query())
+        }
+        with self._lock:
+            self._entries = entries
+            self._version += 1
+        print(f"User directory loaded: {len(entries)} users")
+
+    def get(self, user_id: Optional[int]) -> Optional[UserEntry]:
+        return self._entries.get(user_id)
+
+    def name(self, user_id: Optional[int]) -> Optional[str]:
+        """Display name of a user (None for unknown ids)"""
+        entry = self._entries.get(user_id)
+        return entry.name if entry else None
+
+    def missing(self, user_ids: Iterable[Optional[int]]) -> List[int]:
+        """Distinct user ids (unknown scans left out) not in the directory"""
+        return [user_id for user_id in set(user_ids) if user_id and user_id not in self._entries]
+
+    def fetch_missing(self, db: Session, user_ids: Iterable[Optional[int]]):
+        """Add the users among user_ids the directory does not know yet (one query, none when all known)"""
+        missing = self.missing(user_ids)
+        if missing:
+            self._add(db.execute(_entries_query().where(User.id.in_(missing))))
+
+    async def fetch_missing_async(self, db: AsyncSession, user_ids: Iterable[Optional[int]]):
+        """fetch_missing on an async session"""
+        missing = self.missing(user_ids)
+        if missing:
+            self._add(await db.execute(_entries_query().where(User.id.in_(missing))))
+
+    def items(self) -> List[Tuple[int, UserEntry]]:
+        """Consistent copy of every (id, entry)"""
+        with self._lock:
+            return list(self._entries.items())
+
+    def set(self, user_id: int, name: str, code: str, has_encoding: bool):
+        """Add a user or replace its entry"""
+        with self._lock:
+            self._entries[user_id] = UserEntry(name, code, has_encoding)
+            self._version += 1
+
+    def mark_enrolled(self, user_id: int):
+        """Record that a user now has a face encoding"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry.has_encoding:
+                return
+            self._entries[user_id] = entry._replace(has_encoding=True)
+            self._version += 1
+
+    def _add(self, rows):
+        with self._lock:
+            for user_id, name, code, encoded in rows:
+                self._entries[user_id] = UserEntry(name, code, bool(encoded))
+            self._version += 1
+
+    def remove(self, user_id: int):
+        """Forget a deleted user"""
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self._version += 1
+
+
+# Process-wide user directory
+user_directory = UserDirectory()
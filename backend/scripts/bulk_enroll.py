@@ -0,0 +1,74 @@
+"""
+Script to bulk enroll faces from a directory of images named by user code
+"""
+import csv
+import sys
+from itertools import islice
+from pathlib import Path
+
+# Add parent directory to path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.config import FACE_WORKERS, BULK_ENROLL_BATCH_SIZE
+from app.database import SessionLocal, init_db
+from app.services.face_pool import create_face_executor
+from app.services.face_service import extract_encoding_from_bytes
+from app.services.enrollment_service import iter_directory_images, commit_bulk_batch, summarize_results
+
+
+def bulk_enroll(directory: str, workers: int, batch_size: int, report_path: str = None):
+    """Encode every image in parallel and enroll it for the user with the matching code"""
+    init_db()
+
+    images = iter_directory_images(Path(directory))
+    results = []
+    seen_codes = set()
+
+    db = SessionLocal()
+    executor = create_face_executor(workers)
+
+    try:
+        while True:
+            batch = list(islice(images, batch_size))
+            if not batch:
+                break
+
+            encodings = executor.map(extract_encoding_from_bytes, [image_bytes for _, image_bytes in batch])
+            batch_results = commit_bulk_batch(
+                db,
+                [(filename, image_bytes, encoding) for (filename, image_bytes), encoding in zip(batch, encodings)],
+                seen_codes
+            )
+            results.extend(batch_results)
+            print(f"Processed {len(results)} images")
+
+        for status, count in sorted(summarize_results(results).items()):
+            print(f"  {status}: {count}")
+
+        if report_path:
+            with open(report_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=["file", "code", "user_id", "status", "detail"])
+                writer.writeheader()
+                writer.writerows(results)
+            print(f"✓ Report written to {report_path}")
+
+    except Exception as e:
+        print(f"✗ Error during bulk enrollment: {e}")
+        db.rollback()
+        raise
+    finally:
+        executor.shutdown()
+        db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bulk enroll faces from a directory of <user code>.jpg images")
+    parser.add_argument("directory", help="Directory containing images named by user code")
+    parser.add_argument("--workers", type=int, default=FACE_WORKERS, help="Number of encoding processes")
+    parser.add_argument("--batch-size", type=int, default=BULK_ENROLL_BATCH_SIZE, help="Images committed per transaction")
+    parser.add_argument("--report", help="Write a per-file CSV report to this path")
+
+    args = parser.parse_args()
+    bulk_enroll(args.directory, args.workers, args.batch_size, args.report)
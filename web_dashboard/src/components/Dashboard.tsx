@@ -25,11 +25,40 @@ function Dashboard() {
     const wsUrl = 'ws://localhost:8000/ws'
     wsClient = new WebSocketClient(wsUrl)
     
-    wsClient.on('attendance', (data: any) => {
-      setRecentScans(prev => [data, ...prev.slice(0, 9)])
+    wsClient.on('attendance', (message: any) => {
+      const scan = message.data
+      setRecentScans(prev => [scan, ...prev.slice(0, 9)])
+      setStats((prev: any) => prev && {
+        ...prev,
+        total_today: prev.total_today + 1,
+        total_this_week: prev.total_this_week + 1,
+        total_this_month: prev.total_this_month + 1
+      })
+    })
+    
+    // Replayed kiosk buffers may span several days, refetch once per batch
+    wsClient.on('attendance_batch', () => {
       loadStats()
     })
     
+    // First check-in of a user today: move them to the checked-in list
+    wsClient.on('presence', (message: any) => {
+      const { user_name, checked_in_today, total_users } = message.data
+      setStats((prev: any) => {
+        if (!prev) return prev
+        const notCheckedIn = [...prev.not_checked_in_users]
+        const index = notCheckedIn.indexOf(user_name)
+        if (index > -1) notCheckedIn.splice(index, 1)
+        return {
+          ...prev,
+          checked_in_today,
+          total_users,
+          checked_in_users: [...prev.checked_in_users, user_name].sort(),
+          not_checked_in_users: notCheckedIn
+        }
+      })
+    })
+    
     wsClient.connect()
   }
 
@@ -63,10 +63,30 @@ function Reports() {
     setFilteredAttendance(filtered)
   }
 
-  const handleExportCSV = () => {
-    const dataToExport = filteredAttendance.length > 0 ? filteredAttendance : attendance
-    const csv = convertToCSV(dataToExport)
-    const blob = new Blob([csv], { type: 'text/csv' })
+  const handleExportCSV = async () => {
+    let blob: Blob
+    if (filters.user_name && filters.user_name.trim() !== '') {
+      // Name filter only exists client-side, export what is shown
+      const dataToExport = filteredAttendance.length > 0 ? filteredAttendance : attendance
+      blob = new Blob([convertToCSV(dataToExport)], { type: 'text/csv' })
+    } else {
+      // Server streams every matching record, not just the loaded page
+      const params: any = {
+        format: 'csv',
+        start_date: filters.start_date,
+        end_date: filters.end_date
+      }
+      if (filters.user_id) params.user_id = parseInt(filters.user_id)
+      if (filters.status) params.status = filters.status
+      try {
+        const response = await api.get('/api/attendance/export', { params, responseType: 'blob' })
+        blob = response.data
+      } catch (error) {
+        console.error('Error exporting attendance:', error)
+        alert('Failed to export attendance records')
+        return
+      }
+    }
     const url = window.URL.createObjectURL(blob)
     const a = document.createElement('a')
     a.href = url
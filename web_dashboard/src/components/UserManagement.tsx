@@ -11,23 +11,36 @@ interface User {
   has_encoding: boolean
 }
 
+// Users fetched per request; further pages are loaded with the X-Next-Cursor header
+const PAGE_SIZE = 100
+
 function UserManagement() {
   const [users, setUsers] = useState<User[]>([])
   const [loading, setLoading] = useState(true)
+  const [search, setSearch] = useState('')
+  const [nextCursor, setNextCursor] = useState<string | null>(null)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [showAddForm, setShowAddForm] = useState(false)
   const [editingUser, setEditingUser] = useState<User | null>(null)
   const [formData, setFormData] = useState({ name: '', code: '' })
   const [enrollingUser, setEnrollingUser] = useState<User | null>(null)
 
   useEffect(() => {
-    loadUsers()
-  }, [])
+    // Debounced so typing a name sends a single request
+    const timer = setTimeout(() => loadUsers(), search ? 300 : 0)
+    return () => clearTimeout(timer)
+  }, [search])
+
+  const fetchPage = (cursor?: string) =>
+    api.get('/api/users', {
+      params: { limit: PAGE_SIZE, q: search.trim() || undefined, cursor }
+    })
 
   const loadUsers = async () => {
     try {
-      setLoading(true)
-      const response = await api.get('/api/users')
+      const response = await fetchPage()
       setUsers(response.data)
+      setNextCursor(response.headers['x-next-cursor'] ?? null)
     } catch (error) {
       alert('Failed to load users')
     } finally {
@@ -35,6 +48,23 @@ function UserManagement() {
     }
   }
 
+  const loadMore = async () => {
+    if (!nextCursor) {
+      return
+    }
+
+    try {
+      setLoadingMore(true)
+      const response = await fetchPage(nextCursor)
+      setUsers((previous) => [...previous, ...response.data])
+      setNextCursor(response.headers['x-next-cursor'] ?? null)
+    } catch (error) {
+      alert('Failed to load more users')
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
   const handleAdd = () => {
     setFormData({ name: '', code: '' })
     setEditingUser(null)
@@ -117,6 +147,14 @@ function UserManagement() {
         </button>
       </div>
 
+      <input
+        type="text"
+        value={search}
+        onChange={(e) => setSearch(e.target.value)}
+        placeholder="Search by name or code"
+        className="w-full max-w-sm mb-4 px-3 py-2.5 border border-gray-300 rounded-md text-sm transition-all focus:outline-none focus:border-blue-500 focus:ring-2 focus:ring-blue-200"
+      />
+
       {showAddForm && (
         <div
           className="fixed inset-0 bg-black/50 flex justify-center items-center z-[1000]"
@@ -188,7 +226,7 @@ function UserManagement() {
           {users.length === 0 ? (
             <tr>
               <td colSpan={6} className="p-8 text-center text-gray-600 italic">
-                No users found. Click "Add User" to create one.
+                {search.trim() ? 'No users match this search.' : 'No users found. Click "Add User" to create one.'}
               </td>
             </tr>
           ) : (
@@ -253,6 +291,18 @@ function UserManagement() {
           )}
         </tbody>
       </table>
+
+      {nextCursor && (
+        <div className="flex justify-center mt-4">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="px-5 py-2.5 bg-gray-500 text-white rounded-md text-sm font-medium transition-all hover:bg-gray-600 disabled:opacity-60"
+          >
+            {loadingMore ? 'Loading...' : 'Load more'}
+          </button>
+        </div>
+      )}
     </div>
   )
 }
@@ -21,7 +21,17 @@ class WebSocketClient {
         this.reconnectAttempts = 0
       }
 
+      this.ws.binaryType = 'arraybuffer'
+
       this.ws.onmessage = (event) => {
+        if (event.data instanceof ArrayBuffer) {
+          // Camera frame: u8 device id length, device id, JPEG bytes
+          const length = new Uint8Array(event.data, 0, 1)[0]
+          const device_id = new TextDecoder().decode(new Uint8Array(event.data, 1, length))
+          const frame = new Blob([new Uint8Array(event.data, 1 + length)], { type: 'image/jpeg' })
+          this.emit('camera_frame', { device_id, frame })
+          return
+        }
         try {
           const data = JSON.parse(event.data)
           this.emit(data.type || 'message', data)
@@ -77,6 +87,15 @@ class WebSocketClient {
     }
   }
 
+  // Receive binary camera frames of a kiosk ('camera_frame' events)
+  subscribeCamera(deviceId: string) {
+    this.send({ type: 'subscribe_camera', device_id: deviceId })
+  }
+
+  unsubscribeCamera(deviceId: string) {
+    this.send({ type: 'unsubscribe_camera', device_id: deviceId })
+  }
+
   send(data: any) {
     if (this.ws && this.ws.readyState === WebSocket.OPEN) {
       this.ws.send(JSON.stringify(data))